@@ -29,9 +29,9 @@ document.addEventListener('DOMContentLoaded', async () => {
     
     // Set Telegram link (still using title for the backend)
     const telegramLink = document.getElementById('telegram-link');
-    telegramLink.href = `https://t.me/meme_kino_bot?start=video_${encodeURIComponent(movie.title)}`;
+    telegramLink.href = telegramStartLink(movie, 'video');
 
     // Trailer
     const trailerLink = document.getElementById('trailer-link');
-    trailerLink.href = `https://t.me/meme_kino_bot?start=trailer_${encodeURIComponent(movie.title)}`;
+    trailerLink.href = telegramStartLink(movie, 'trailer');
 });
\ No newline at end of file
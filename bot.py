@@ -4,22 +4,41 @@ import json
 import io
 import asyncio
 import re 
-from telegram.error import RetryAfter
+import sys
+import sqlite3
+import threading
+import weakref
+import time
+import hashlib
+import bisect
+import heapq
+import math
+import httpx
+from contextlib import asynccontextmanager
+from collections import Counter, deque
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
 from PIL import Image
 from datetime import datetime, timedelta
-from telegram import InputMediaPhoto
+from telegram import InputMediaPhoto, InputMediaVideo
 from telegram import Message, Chat, User
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackContext,
     CallbackQueryHandler,
+    InlineQueryHandler,
+    TypeHandler,
+    BaseUpdateProcessor,
     filters
 )
 
+# Read .env before any settings below are resolved
+load_dotenv()
+
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
@@ -38,9 +57,13 @@ PHOTO_LOG_FILE = 'db/photo_logs.json'        # For photo logs
 VIDEO_LOG_FILE = 'db/video_logs.json'        # For video delivery logs
 BLOCKED_USERS_FILE = 'db/blocked_users.json'
 USER_BALANCES_FILE = 'db/user_balances.json'
+PURCHASES_FILE = 'db/purchases.json'         # Videos each user has paid for
+VIDEO_ALIASES_FILE = 'db/video_aliases.json' # Every slug a video id has had
+BROADCASTS_FILE = 'db/broadcasts.json'       # Broadcast outbox (scheduled and in-flight)
 MOVIE_DETAILS = 'movie-details.json'
 LINK = 'Google ээс memekino.com '
 TROUBLESHOOT_VIDEO = "BAACAgUAAxkBAAIBYGgFrrE_duOgAZxidZtuEcMB3OnZAALQFQACeyIQVL478CRT6Y0CNgQ"
+TROUBLESHOOT_VIDEO_NAME = "aldaa_troubleshooting_video"
 
 # Subscription prices
 SUBSCRIPTION_PRICES = {
@@ -60,92 +83,1412 @@ SUBSCRIPTION_PRICES = {
 
 CATEGORIES = ['movielex', 'animelex', 'seriallex', 'lgbtlex']
 
-# Dictionary to store video IDs and names
-video_db = {}
+# Balance a user starts with
+DEFAULT_BALANCE = 5000
+
+# Upper bound on updates handled at the same time (across all chats)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '32'))
+
+# Broadcast sending: Telegram allows ~30 messages/second per bot overall
+# (and ~1/second per chat, which a broadcast never exceeds: one message each)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_PROGRESS_INTERVAL = 15  # seconds between admin progress updates
+BROADCAST_CURSOR_DIR = 'db/broadcasts'  # per-recipient delivery status of each broadcast
+
+# How often (seconds) dirty state is written back to storage
+STATE_FLUSH_INTERVAL = int(os.getenv('STATE_FLUSH_INTERVAL', '5'))
+
+# Balance ledger: every movement is appended to db/ledger/ledger.jsonl and
+# all balances are checkpointed this often (seconds), so a restart only
+# replays the movements written since
+LEDGER_DIR = 'db/ledger'
+LEDGER_SNAPSHOT_INTERVAL = int(os.getenv('LEDGER_SNAPSHOT_INTERVAL', '600'))
+
+# System account on the other side of each kind of movement
+LEDGER_CONTRA = {
+    'opening': '@opening',             # balances that existed before the ledger, and new accounts
+    'topup': '@topups',                # /addbalance
+    'purchase': '@revenue',            # pay-per-video
+    'subscription': '@revenue',
+    'refund': '@revenue',
+    'referral_bonus': '@promotions',
+}
+
+# Storage engine: 'json' (db/*.json files) or 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+SQLITE_DB_FILE = os.getenv('SQLITE_DB_FILE', 'db/memekino.db')
+
+# Per-user log files and the key holding each user's entries
+# (None means the user maps straight to a list)
+LOG_LIST_KEYS = {
+    VIDEO_LOG_FILE: 'deliveries',
+    CHAT_LOG_FILE: 'messages',
+    PHOTO_LOG_FILE: 'photos',
+    SUBSCRIPTION_LOGS_FILE: None,
+}
+
+# Append-only journal that replaces rewriting video_logs.json
+VIDEO_JOURNAL_DIR = 'db/video_logs'
+VIDEO_JOURNAL_SEGMENT_BYTES = int(os.getenv('VIDEO_JOURNAL_SEGMENT_BYTES', str(4 * 1024 * 1024)))
+
+class DeliveryJournal:
+    """Append-only JSONL journal of video deliveries.
+
+    Records go to deliveries-YYYYMMDD-NNN.jsonl segments; a new segment is
+    started every day and whenever the current one grows past max_bytes.
+    The per-user view returned by load_video_logs() is rebuilt by replaying
+    the segments in order at startup. A compacted segment starts with a
+    "compacted" record and replaces everything before it, so replay starts
+    at the newest one even if a crash left the older segments behind.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._file = None
+        self._day = None
+
+    def _segments(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            os.path.join(self.directory, name) for name in names
+            if name.startswith('deliveries-') and name.endswith('.jsonl')
+        )
+
+    def _segment_path(self, day, seq):
+        return os.path.join(self.directory, f"deliveries-{day}-{seq:03d}.jsonl")
+
+    @staticmethod
+    def _segment_seq(path):
+        return int(path.rsplit('-', 1)[1].split('.')[0])
+
+    def _next_segment_path(self, day):
+        today = [p for p in self._segments() if os.path.basename(p).startswith(f"deliveries-{day}-")]
+        return self._segment_path(day, self._segment_seq(today[-1]) + 1 if today else 0)
+
+    @staticmethod
+    def _is_compacted(segment):
+        with open(segment, 'r', encoding='utf-8') as f:
+            first = f.readline()
+        try:
+            return json.loads(first).get('op') == 'compacted'
+        except json.JSONDecodeError:
+            return False
+
+    def _current_file(self):
+        day = datetime.now().strftime('%Y%m%d')
+        if self._file and self._day == day and self._file.tell() < self.max_bytes:
+            return self._file
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self._day = day
+        self._file = open(self._next_segment_path(day), 'a', encoding='utf-8')
+        return self._file
+
+    def write(self, record):
+        """Append one record; cost does not depend on history size"""
+        f = self._current_file()
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+
+    @staticmethod
+    def _apply(logs, record):
+        op = record.get('op')
+        if op == 'user':
+            logs.setdefault(record['user_id'], {
+                'username': record.get('username'),
+                'first_name': record.get('first_name'),
+                'deliveries': []
+            })
+        elif op == 'delivery':
+            user_log = logs.setdefault(record['user_id'], {'username': '', 'first_name': '', 'deliveries': []})
+            user_log['deliveries'].append(record['entry'])
+
+    @staticmethod
+    def records_for(logs):
+        """Yield the journal records that reproduce a per-user view"""
+        for user_id, user_log in logs.items():
+            yield {
+                'op': 'user',
+                'user_id': user_id,
+                'username': user_log.get('username'),
+                'first_name': user_log.get('first_name')
+            }
+            for delivery in user_log.get('deliveries', []):
+                yield {'op': 'delivery', 'user_id': user_id, 'entry': delivery}
+
+    def load(self, legacy_path):
+        """Rebuild the per-user view, importing legacy_path on first run"""
+        if not self._segments() and os.path.exists(legacy_path):
+            try:
+                with open(legacy_path, 'r', encoding='utf-8') as f:
+                    self.compact(json.load(f))
+                logger.info(f"Imported {legacy_path} into {self.directory}")
+            except json.JSONDecodeError as e:
+                logger.error(f"Could not import {legacy_path}: {e}")
+        segments = self._segments()
+        start = next((i for i in range(len(segments) - 1, -1, -1) if self._is_compacted(segments[i])), 0)
+        for segment in segments[:start]:
+            # Left behind by a crash during compaction; already in segments[start]
+            logger.info(f"Removing superseded segment {segment}")
+            os.remove(segment)
+        logs = {}
+        for segment in segments[start:]:
+            with open(segment, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line after a crash; the rest is intact
+                        logger.warning(f"Skipping unreadable record in {segment}")
+                        continue
+                    self._apply(logs, record)
+        return logs
+
+    def start_compaction(self, logs):
+        """Reserve a compacted segment for logs and return the work for write_compaction().
+
+        Only copies references, so it is cheap enough for the event loop.
+        Deliveries written from now on go to a segment ordered after the
+        compacted one.
+        """
+        self.close()
+        old_segments = self._segments()
+        os.makedirs(self.directory, exist_ok=True)
+        day = datetime.now().strftime('%Y%m%d')
+        path = self._next_segment_path(day)
+        self._day = day
+        self._file = open(self._segment_path(day, self._segment_seq(path) + 1), 'a', encoding='utf-8')
+        view = {
+            user_id: {**user_log, 'deliveries': list(user_log.get('deliveries', []))}
+            for user_id, user_log in logs.items()
+        }
+        return path, old_segments, view
+
+    def write_compaction(self, path, old_segments, view):
+        """Write the compacted segment, then drop the segments it replaces"""
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'op': 'compacted'}) + '\n')
+            for record in self.records_for(view):
+                f.write(json.dumps(record) + '\n')
+        os.replace(f"{path}.tmp", path)
+        for segment in old_segments:
+            os.remove(segment)
+
+    def compact(self, logs):
+        """Replace all segments with one holding the current view"""
+        self.write_compaction(*self.start_compaction(logs))
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+class JsonStateStore:
+    """Process-wide cache of the db/*.json files.
+
+    Each file is parsed once on first access and then served from memory.
+    Writers mark a file dirty and the whole set of dirty files is written
+    back by flush(), which runs on a timer and at shutdown. Video deliveries
+    are the exception: they are appended to a DeliveryJournal as they happen.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._dirty = set()
+        self._journal = DeliveryJournal(VIDEO_JOURNAL_DIR, VIDEO_JOURNAL_SEGMENT_BYTES)
+        # Handlers flush too, not just flush_state_job: one flush at a time,
+        # so an older snapshot can never land after a newer one
+        self._flush_lock = asyncio.Lock()
+
+    def get(self, path, migrate=None):
+        """Return the in-memory object for path, loading it on first use"""
+        if path == VIDEO_LOG_FILE and path not in self._data:
+            self._data[path] = self._journal.load(VIDEO_LOG_FILE)
+        if path not in self._data:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                data = {}
+            if migrate:
+                data = migrate(data)
+            self._data[path] = data
+        return self._data[path]
+
+    def put(self, path, data):
+        """Replace the in-memory object for path and schedule a write"""
+        self._data[path] = data
+        self._dirty.add(path)
+
+    def mark_dirty(self, path):
+        """Schedule a write of path after an in-place change"""
+        if path in self._data:
+            self._dirty.add(path)
+
+    def _append_in_memory(self, path, user_id, entry, header):
+        logs = self.get(path)
+        list_key = LOG_LIST_KEYS[path]
+        if list_key is None:
+            logs.setdefault(user_id, []).append(entry)
+            return
+        if user_id not in logs:
+            logs[user_id] = {**(header or {}), list_key: []}
+        logs[user_id][list_key].append(entry)
+
+    def append(self, path, user_id, entry, header=None):
+        """Append one entry to a user's log, creating it from header if new"""
+        if path != VIDEO_LOG_FILE:
+            self._append_in_memory(path, user_id, entry, header)
+            self._dirty.add(path)
+            return
+        if user_id not in self.get(path):
+            self._journal.write({'op': 'user', 'user_id': user_id, **(header or {})})
+        self._append_in_memory(path, user_id, entry, header)
+        self._journal.write({'op': 'delivery', 'user_id': user_id, 'entry': entry})
+
+    def _snapshot(self):
+        """Serialize dirty files and clear the dirty set"""
+        pending = {}
+        if VIDEO_LOG_FILE in self._dirty:
+            # A wholesale replacement of the delivery view compacts the journal
+            self._dirty.discard(VIDEO_LOG_FILE)
+            pending[VIDEO_LOG_FILE] = self._journal.start_compaction(self._data[VIDEO_LOG_FILE])
+        pending.update((path, json.dumps(self._data[path], indent=2)) for path in self._dirty)
+        self._dirty.clear()
+        return pending
+
+    def _write_files(self, pending):
+        for path, text in pending.items():
+            if path == VIDEO_LOG_FILE:
+                self._journal.write_compaction(*text)
+                continue
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+
+    def flush(self):
+        """Write all dirty files to disk"""
+        self._write_files(self._snapshot())
 
-def load_video_db():
-    """Load video database from movie-details.json file"""
-    global video_db
+    async def flush_async(self):
+        """Write all dirty files to disk without blocking the event loop"""
+        async with self._flush_lock:
+            pending = self._snapshot()
+            if pending:
+                try:
+                    await asyncio.to_thread(self._write_files, pending)
+                except Exception:
+                    # Keep the files dirty so the next flush retries them
+                    self._dirty.update(pending)
+                    raise
+
+    def close(self):
+        """Release open file handles"""
+        self._journal.close()
+
+SQLITE_KEYED_TABLES = {
+    USER_BALANCES_FILE: 'balances',
+    SUBSCRIPTIONS_FILE: 'subscriptions',
+    USER_ACTIVITY_FILE: 'user_activity',
+    BLOCKED_USERS_FILE: 'blocked_users',
+    PURCHASES_FILE: 'purchases',
+    VIDEO_ALIASES_FILE: 'video_aliases',
+    MOVIE_DETAILS: 'videos',
+    BROADCASTS_FILE: 'broadcasts',
+}
+
+# path -> (table, columns); other entry fields are kept as JSON in "extra"
+SQLITE_LOG_TABLES = {
+    VIDEO_LOG_FILE: ('video_logs', ('timestamp', 'video_id', 'video_name', 'status')),
+    CHAT_LOG_FILE: ('chat_logs', ('timestamp', 'text', 'chat_type')),
+    PHOTO_LOG_FILE: ('photo_logs', ('timestamp', 'photo_file_id', 'caption')),
+    SUBSCRIPTION_LOGS_FILE: ('subscription_logs', ('timestamp', 'action', 'details')),
+}
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS balances (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS subscriptions (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS user_activity (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS blocked_users (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS purchases (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS video_aliases (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS videos (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS broadcasts (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_user_activity_referred_by ON user_activity (json_extract(data, '$.referred_by'));
+CREATE INDEX IF NOT EXISTS idx_videos_category ON videos (json_extract(data, '$.category'));
+CREATE INDEX IF NOT EXISTS idx_videos_date_added ON videos (json_extract(data, '$.date_added'));
+
+CREATE TABLE IF NOT EXISTS log_users (
+    log TEXT NOT NULL, user_id TEXT NOT NULL, username TEXT, first_name TEXT,
+    PRIMARY KEY (log, user_id)
+);
+CREATE TABLE IF NOT EXISTS video_logs (
+    id INTEGER PRIMARY KEY, user_id TEXT NOT NULL,
+    timestamp TEXT, video_name TEXT, status TEXT, extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_video_logs_user_id ON video_logs (user_id);
+CREATE INDEX IF NOT EXISTS idx_video_logs_video_name ON video_logs (video_name);
+CREATE INDEX IF NOT EXISTS idx_video_logs_timestamp ON video_logs (timestamp);
+CREATE TABLE IF NOT EXISTS chat_logs (
+    id INTEGER PRIMARY KEY, user_id TEXT NOT NULL,
+    timestamp TEXT, text TEXT, chat_type TEXT, extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_chat_logs_user_id ON chat_logs (user_id);
+CREATE INDEX IF NOT EXISTS idx_chat_logs_timestamp ON chat_logs (timestamp);
+CREATE TABLE IF NOT EXISTS photo_logs (
+    id INTEGER PRIMARY KEY, user_id TEXT NOT NULL,
+    timestamp TEXT, photo_file_id TEXT, caption TEXT, extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_photo_logs_user_id ON photo_logs (user_id);
+CREATE INDEX IF NOT EXISTS idx_photo_logs_timestamp ON photo_logs (timestamp);
+CREATE TABLE IF NOT EXISTS subscription_logs (
+    id INTEGER PRIMARY KEY, user_id TEXT NOT NULL,
+    timestamp TEXT, action TEXT, details TEXT, extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_subscription_logs_user_id ON subscription_logs (user_id);
+CREATE INDEX IF NOT EXISTS idx_subscription_logs_timestamp ON subscription_logs (timestamp);
+"""
+
+class SqliteStateStore(JsonStateStore):
+    """SQLite (WAL mode) storage behind the same get/put/append interface.
+
+    Keyed collections (balances, subscriptions, ...) are stored one row per
+    key and a flush only writes the keys that changed. Logs are stored one
+    row per entry, so append() turns into a single-row insert.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SQLITE_SCHEMA)
+        self._add_video_id_column()
+        self._lock = threading.Lock()
+        self._rows = {}        # keyed path -> {key: serialized data} as last written
+        self._appends = []     # (path, user_id, header, entry) waiting to be inserted
+        self._rewrite = set()  # log paths to rewrite completely on next flush
+
+    def _add_video_id_column(self):
+        # Databases created before numeric video ids lack this column
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(video_logs)")]
+        if 'video_id' not in columns:
+            self._conn.execute("ALTER TABLE video_logs ADD COLUMN video_id INTEGER")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_video_logs_video_id ON video_logs (video_id)")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _load_rows(self, path):
+        if path not in self._rows:
+            table = SQLITE_KEYED_TABLES[path]
+            self._rows[path] = dict(self._query(f"SELECT key, data FROM {table}"))
+        return self._rows[path]
+
+    def get(self, path, migrate=None):
+        if path in self._data:
+            return self._data[path]
+        if path in SQLITE_KEYED_TABLES:
+            data = {key: json.loads(row) for key, row in self._load_rows(path).items()}
+        else:
+            data = self._load_log(path)
+        if migrate:
+            data = migrate(data)
+        self._data[path] = data
+        return data
+
+    def _load_log(self, path):
+        table, columns = SQLITE_LOG_TABLES[path]
+        list_key = LOG_LIST_KEYS[path]
+        logs = {}
+        if list_key is not None:
+            for user_id, username, first_name in self._query(
+                    "SELECT user_id, username, first_name FROM log_users WHERE log = ?", (table,)):
+                logs[user_id] = {'username': username, 'first_name': first_name, list_key: []}
+        rows = self._query(f"SELECT user_id, {', '.join(columns)}, extra FROM {table} ORDER BY id")
+        for user_id, *values, extra in rows:
+            entry = {column: value for column, value in zip(columns, values)
+                     if value is not None or column not in ('video_id', 'video_name')}
+            if 'details' in entry and entry['details'] is not None:
+                entry['details'] = json.loads(entry['details'])
+            if extra:
+                entry.update(json.loads(extra))
+            if list_key is None:
+                logs.setdefault(user_id, []).append(entry)
+            else:
+                logs.setdefault(user_id, {'username': None, 'first_name': None, list_key: []})
+                logs[user_id][list_key].append(entry)
+        return logs
+
+    def put(self, path, data):
+        self._data[path] = data
+        self.mark_dirty(path)
+
+    def mark_dirty(self, path):
+        if path not in self._data:
+            return
+        if path in SQLITE_LOG_TABLES:
+            # In-place edits (e.g. /rename) can touch any row: rewrite the log
+            self._rewrite.add(path)
+            self._appends = [item for item in self._appends if item[0] != path]
+        else:
+            self._dirty.add(path)
+
+    def append(self, path, user_id, entry, header=None):
+        self._append_in_memory(path, user_id, entry, header)
+        if path not in self._rewrite:
+            self._appends.append((path, user_id, header, entry))
+
+    @staticmethod
+    def _log_row(path, user_id, entry):
+        columns = SQLITE_LOG_TABLES[path][1]
+        values = [entry.get(column) for column in columns]
+        if 'details' in columns:
+            values[columns.index('details')] = json.dumps(entry.get('details'))
+        extra = {k: v for k, v in entry.items() if k not in columns}
+        return (user_id, *values, json.dumps(extra) if extra else None)
+
+    def _snapshot(self):
+        """Collect pending writes as (sql, rows) batches and clear them"""
+        batches = []
+        for path in self._dirty:
+            table = SQLITE_KEYED_TABLES[path]
+            written = self._load_rows(path)
+            current = {key: json.dumps(value) for key, value in self._data[path].items()}
+            upserts = [(k, v) for k, v in current.items() if written.get(k) != v]
+            deletes = [(k,) for k in written if k not in current]
+            if upserts:
+                batches.append((f"INSERT OR REPLACE INTO {table} (key, data) VALUES (?, ?)", upserts))
+            if deletes:
+                batches.append((f"DELETE FROM {table} WHERE key = ?", deletes))
+            self._rows[path] = current
+        for path in self._rewrite:
+            table, columns = SQLITE_LOG_TABLES[path]
+            batches.append((f"DELETE FROM {table}", [()]))
+            batches.append(("DELETE FROM log_users WHERE log = ?", [(table,)]))
+            headers, rows = [], []
+            for user_id, user_log in self._data[path].items():
+                list_key = LOG_LIST_KEYS[path]
+                entries = user_log if list_key is None else user_log.get(list_key, [])
+                if list_key is not None:
+                    headers.append((table, user_id, user_log.get('username'), user_log.get('first_name')))
+                rows.extend(self._log_row(path, user_id, entry) for entry in entries)
+            batches.extend(self._log_batches(path, headers, rows))
+        for path, user_id, header, entry in self._appends:
+            table = SQLITE_LOG_TABLES[path][0]
+            headers = []
+            if header is not None:
+                headers.append((table, user_id, header.get('username'), header.get('first_name')))
+            batches.extend(self._log_batches(path, headers, [self._log_row(path, user_id, entry)]))
+        self._dirty.clear()
+        self._rewrite.clear()
+        self._appends = []
+        return batches
+
+    @staticmethod
+    def _log_batches(path, headers, rows):
+        table, columns = SQLITE_LOG_TABLES[path]
+        batches = []
+        if headers:
+            batches.append((
+                "INSERT OR IGNORE INTO log_users (log, user_id, username, first_name) VALUES (?, ?, ?, ?)",
+                headers
+            ))
+        if rows:
+            placeholders = ', '.join('?' * (len(columns) + 2))
+            batches.append((
+                f"INSERT INTO {table} (user_id, {', '.join(columns)}, extra) VALUES ({placeholders})",
+                rows
+            ))
+        return batches
+
+    def _write_files(self, batches):
+        with self._lock, self._conn:
+            for sql, rows in batches:
+                self._conn.executemany(sql, rows)
+
+    def flush(self):
+        batches = self._snapshot()
+        if batches:
+            self._write_files(batches)
+
+    async def flush_async(self):
+        async with self._flush_lock:
+            batches = self._snapshot()
+            if not batches:
+                return
+            try:
+                await asyncio.to_thread(self._write_files, batches)
+            except Exception:
+                # The transaction rolled back: resync everything on the next flush
+                self._rows.clear()
+                self._dirty.update(p for p in self._data if p in SQLITE_KEYED_TABLES)
+                self._rewrite.update(p for p in self._data if p in SQLITE_LOG_TABLES)
+                self._appends = []
+                raise
+
+    def import_collection(self, path, data):
+        """Replace a whole collection (used by the JSON migration)"""
+        self._data[path] = data
+        if path in SQLITE_KEYED_TABLES:
+            self._rows[path] = {}
+            with self._lock, self._conn:
+                self._conn.execute(f"DELETE FROM {SQLITE_KEYED_TABLES[path]}")
+        self.mark_dirty(path)
+
+    def close(self):
+        super().close()
+        with self._lock:
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._conn.close()
+
+def create_state_store():
+    """Build the storage engine selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStateStore(SQLITE_DB_FILE)
+    return JsonStateStore()
+
+def migrate_json_to_sqlite():
+    """One-shot import of db/*.json and movie-details.json into SQLite"""
+    source = JsonStateStore()
+    target = SqliteStateStore(SQLITE_DB_FILE)
+    for path in list(SQLITE_KEYED_TABLES) + list(SQLITE_LOG_TABLES):
+        migrate = _replay_user_balances if path == USER_BALANCES_FILE else None
+        data = source.get(path, migrate=migrate)
+        target.import_collection(path, data)
+        logger.info(f"Imported {len(data)} records from {path}")
+    target.flush()
+    target.close()
+    logger.info(f"Migration to {SQLITE_DB_FILE} complete")
+
+state_store = create_state_store()
+
+async def flush_state_job(context: CallbackContext):
+    """Periodic job writing dirty state to disk"""
     try:
-        with open(MOVIE_DETAILS, 'r', encoding='utf-8') as f:
-            video_data = json.load(f)
-            # Create a simplified mapping of title to file_id for backward compatibility
-            video_db = {title: data['file_id'] for title, data in video_data.items()}
-    except (FileNotFoundError, json.JSONDecodeError):
-        video_db = {}
-        # Initialize with empty movie-details.json if it doesn't exist
-        with open(MOVIE_DETAILS, 'w', encoding='utf-8') as f:
-            json.dump({}, f, indent=2)
-
-load_video_db()
+        await state_store.flush_async()
+    except Exception as e:
+        logger.error(f"Error flushing state: {e}")
 
-def load_user_balances():
-    """Load user balances from JSON file"""
+async def flush_state_on_shutdown(application: Application):
+    """Write any pending state before the process exits"""
+    state_store.flush()
+    state_store.close()
+    broadcast_outbox.close()
+    balance_ledger.snapshot()
+    balance_ledger.close()
+
+# Seconds between checks of movie-details.json for outside edits
+CATALOG_CHECK_INTERVAL = float(os.getenv('CATALOG_CHECK_INTERVAL', '2'))
+
+# Trailing season/episode (or year) numbers: secret-relationship-1-1 -> secret-relationship
+SERIES_SUFFIX = re.compile(r'(-\d+)+$')
+
+BASE62_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+def encode_base62(number):
+    """Short code for a video id, used in deep links and callback data"""
+    code = ''
+    while True:
+        number, digit = divmod(number, 62)
+        code = BASE62_ALPHABET[digit] + code
+        if number == 0:
+            return code
+
+def decode_base62(code):
+    """Video id for a short code, or None if code is not base62"""
+    number = 0
+    for char in code:
+        digit = BASE62_ALPHABET.find(char)
+        if digit < 0:
+            return None
+        number = number * 62 + digit
+    return number
+
+def series_prefix(name):
+    """Series a title belongs to, derived from its slug"""
+    return SERIES_SUFFIX.sub('', name) or name
+
+class VideoCatalog:
+    """In-memory copy of movie-details.json.
+
+    The file is only re-read when its mtime/size changed and its content
+    hash differs from what was loaded, so edits made by hand (or by a
+    website deploy) are picked up without parsing it on every request.
+    Admin commands mutate the catalog through this object, which writes the
+    file back atomically.
+
+    Secondary indexes (category, date_added, price, series) are sorted lists
+    kept up to date by every mutation, so queries like "newest 8 bl titles"
+    read a slice instead of filtering and sorting the whole catalog.
+
+    Every video has a permanent numeric "id". Logs and purchases store the
+    id, and slugs are only aliases for it (db/video_aliases.json keeps
+    every slug an id has had), so a rename never touches history. The id's
+    base62 form is stored as "code" for deep links and buttons.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.videos = {}
+        self._stat = None
+        self._digest = None
+        self._checked_at = 0.0
+        self._next_id = 1
+        self._names_by_id = {}  # id -> current slug (or last slug if deleted)
+        self._reset_indexes()
+
+    def _reset_indexes(self):
+        self._by_category = {}  # category -> [(date_added, name)] oldest first
+        self._by_date = []      # [(date_added, name)] oldest first
+        self._by_price = []     # [(price, name)] cheapest first
+        self._by_series = {}    # series prefix -> [name] sorted
+
+    @staticmethod
+    def _index_keys(name, video):
+        date_key = (str(video.get('date_added') or ''), name)
+        return video.get('category', 'other'), date_key, (video.get('price', 0), name), series_prefix(name)
+
+    def _index(self, name, video):
+        category, date_key, price_key, series = self._index_keys(name, video)
+        bisect.insort(self._by_category.setdefault(category, []), date_key)
+        bisect.insort(self._by_date, date_key)
+        bisect.insort(self._by_price, price_key)
+        bisect.insort(self._by_series.setdefault(series, []), name)
+
+    @staticmethod
+    def _remove_sorted(items, key):
+        i = bisect.bisect_left(items, key)
+        if i < len(items) and items[i] == key:
+            del items[i]
+
+    def _unindex(self, name, video):
+        category, date_key, price_key, series = self._index_keys(name, video)
+        self._remove_sorted(self._by_category.get(category, []), date_key)
+        if not self._by_category.get(category, True):
+            del self._by_category[category]
+        self._remove_sorted(self._by_date, date_key)
+        self._remove_sorted(self._by_price, price_key)
+        self._remove_sorted(self._by_series.get(series, []), name)
+        if not self._by_series.get(series, True):
+            del self._by_series[series]
+
+    def _rebuild_indexes(self):
+        self._reset_indexes()
+        for name, video in self.videos.items():
+            category, date_key, price_key, series = self._index_keys(name, video)
+            self._by_category.setdefault(category, []).append(date_key)
+            self._by_date.append(date_key)
+            self._by_price.append(price_key)
+            self._by_series.setdefault(series, []).append(name)
+        for items in [*self._by_category.values(), self._by_date, self._by_price, *self._by_series.values()]:
+            items.sort()
+
+    def _assign_ids(self):
+        """Give videos without an id/code one; return True if any were added"""
+        aliases = state_store.get(VIDEO_ALIASES_FILE)
+        used = [video['id'] for video in self.videos.values() if 'id' in video]
+        self._next_id = max(used + list(aliases.values()) + [0]) + 1
+        taken = set(used)
+        added = False
+        # Oldest first so existing titles get ids in the order they were added
+        for name, video in sorted(self.videos.items(), key=lambda item: (str(item[1].get('date_added') or ''), item[0])):
+            if 'id' not in video:
+                # A file rewritten without ids keeps the id each slug already had
+                known = aliases.get(name)
+                if known is not None and known not in taken:
+                    video['id'] = known
+                else:
+                    video['id'] = self._next_id
+                    self._next_id += 1
+                taken.add(video['id'])
+                added = True
+            if video.get('code') != encode_base62(video['id']):
+                video['code'] = encode_base62(video['id'])
+                added = True
+            if aliases.get(name) != video['id']:
+                aliases[name] = video['id']
+                state_store.mark_dirty(VIDEO_ALIASES_FILE)
+        self._names_by_id = {video_id: name for name, video_id in aliases.items()}
+        self._names_by_id.update((video['id'], name) for name, video in self.videos.items())
+        return added
+
+    def _add_alias(self, name, video_id):
+        state_store.get(VIDEO_ALIASES_FILE)[name] = video_id
+        state_store.mark_dirty(VIDEO_ALIASES_FILE)
+        self._names_by_id[video_id] = name
+
+    def id_of(self, name):
+        """Numeric id for a current or former slug, or None"""
+        self.refresh()
+        video = self.videos.get(name)
+        if video is not None:
+            return video['id']
+        return state_store.get(VIDEO_ALIASES_FILE).get(name)
+
+    def name_of(self, video_id):
+        """Current slug for an id (last known slug if the video was deleted)"""
+        self.refresh()
+        return self._names_by_id.get(video_id)
+
+    def by_code(self, code):
+        """Current slug for a short code, or None"""
+        video_id = decode_base62(code)
+        name = self.name_of(video_id) if video_id is not None else None
+        return name if name in self.videos else None
+
+    def resolve(self, name):
+        """Current slug for a current or former slug, or None if it is gone"""
+        name = self.name_of(self.id_of(name))
+        return name if name in self.videos else None
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def refresh(self, force=False):
+        """Reload the file if it changed on disk; return True if it did"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < CATALOG_CHECK_INTERVAL:
+            return False
+        self._checked_at = now
+        stat = self._file_stat()
+        if stat is None:
+            if self._digest is None:
+                # First load: initialize with an empty movie-details.json
+                self.videos = {}
+                self._assign_ids()
+                self._rebuild_indexes()
+                self.save()
+                return True
+            # Gone after it was loaded (e.g. mid-deploy): keep serving what we have
+            if self._stat is not None:
+                logger.error(f"{self.path} is missing, keeping the previous catalog")
+                self._stat = None
+            return False
+        if not force and stat == self._stat:
+            return False
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        self._stat = stat
+        digest = hashlib.sha1(raw).hexdigest()
+        if digest == self._digest:
+            return False
+        try:
+            videos = json.loads(raw)
+        except json.JSONDecodeError as e:
+            logger.error(f"Error loading {self.path}, keeping the previous catalog: {e}")
+            return False
+        self._digest = digest
+        self.videos = videos
+        new_ids = self._assign_ids()
+        self._rebuild_indexes()
+        logger.info(f"Loaded {len(videos)} videos from {self.path}")
+        if new_ids:
+            self.save()
+        return True
+
+    @property
+    def revision(self):
+        """Content hash; changes with every reload and every save"""
+        self.refresh()
+        return self._digest
+
+    def save(self):
+        """Write the catalog back atomically"""
+        raw = json.dumps(self.videos, indent=2).encode('utf-8')
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp_path, self.path)
+        self._stat = self._file_stat()
+        self._digest = hashlib.sha1(raw).hexdigest()
+        if isinstance(state_store, SqliteStateStore):
+            # Keep the indexed copy of the catalog in step with the website's file
+            state_store.put(MOVIE_DETAILS, self.videos)
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self.videos
+
+    def __len__(self):
+        self.refresh()
+        return len(self.videos)
+
+    def get(self, name):
+        self.refresh()
+        return self.videos.get(name)
+
+    def items(self):
+        self.refresh()
+        return self.videos.items()
+
+    def file_id(self, name):
+        return self.get(name)['file_id']
+
+    def categories(self):
+        """Categories that currently have at least one video"""
+        self.refresh()
+        return sorted(self._by_category)
+
+    def newest(self, limit=None, category=None):
+        """Video names by date_added, newest first, optionally in one category"""
+        self.refresh()
+        items = self._by_date if category is None else self._by_category.get(category, [])
+        start = 0 if limit is None else max(len(items) - limit, 0)
+        return [name for _, name in reversed(items[start:])]
+
+    def by_price(self, max_price=None):
+        """Video names cheapest first, optionally capped at max_price"""
+        self.refresh()
+        end = len(self._by_price)
+        if max_price is not None:
+            end = bisect.bisect_right(self._by_price, (max_price, chr(0x10FFFF)))
+        return [name for _, name in self._by_price[:end]]
+
+    def series(self, name_or_prefix):
+        """All episodes in the series a title (or series prefix) belongs to"""
+        self.refresh()
+        return list(self._by_series.get(series_prefix(name_or_prefix), []))
+
+    def add_video(self, name, file_id, price):
+        """Create a video entry, or update file_id and price of an existing one"""
+        self.refresh()
+        if name in self.videos:
+            self._unindex(name, self.videos[name])
+        if name not in self.videos:
+            self.videos[name] = {
+                "id": self._next_id,
+                "code": encode_base62(self._next_id),
+                "title": name,
+                "title_name": name,  # Default title_name same as title
+                "year": datetime.now().year,
+                "genre": "Unknown",
+                "duration": "Unknown",
+                "rating": 0.0,
+                "description": "No description available",
+                "director": "Unknown",
+                "cast": "Unknown",
+                "release": datetime.now().strftime('%B %Y'),
+                "poster": "",
+                "category": "other",
+                "file_id": file_id,
+                "trailer_ids": [],
+                "date_added": datetime.now().isoformat(),
+                "price": price
+            }
+            self._next_id += 1
+            self._add_alias(name, self.videos[name]['id'])
+        else:
+            # Just update the file_id if video exists
+            self.videos[name]['file_id'] = file_id
+            self.videos[name]['price'] = price
+        self._index(name, self.videos[name])
+        self.save()
+        return self.videos[name]
+
+    def add_trailer(self, name, trailer_id):
+        """Append a trailer and return the video's trailer list"""
+        self.refresh()
+        trailers = self.videos[name].setdefault('trailer_ids', [])
+        trailers.append(trailer_id)
+        self.save()
+        return trailers
+
+    def update_field(self, name, field, value):
+        self.refresh()
+        self._unindex(name, self.videos[name])
+        self.videos[name][field] = value
+        self._index(name, self.videos[name])
+        self.save()
+
+    def rename(self, old_name, new_name):
+        """Give a video a new slug; False if another video already has it"""
+        self.refresh()
+        if new_name in self.videos:
+            return False
+        self._unindex(old_name, self.videos[old_name])
+        self.videos[new_name] = self.videos.pop(old_name)
+        # Update title if it matches old name
+        if self.videos[new_name]['title'] == old_name:
+            self.videos[new_name]['title'] = new_name
+        self._add_alias(new_name, self.videos[new_name]['id'])
+        self._index(new_name, self.videos[new_name])
+        self.save()
+        return True
+
+    def delete(self, name):
+        self.refresh()
+        self._unindex(name, self.videos.pop(name))
+        self.save()
+
+catalog = VideoCatalog(MOVIE_DETAILS)
+
+SEARCH_TOKEN = re.compile(r'\w+')
+
+# Mongolian Cyrillic -> Latin as people type it in chats
+CYRILLIC_TO_LATIN = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'ye', 'ё': 'yo',
+    'ж': 'j', 'з': 'z', 'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'ө': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+    'у': 'u', 'ү': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'sh', 'ъ': '', 'ы': 'ii', 'ь': 'i', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+})
+# Spellings that vary in Latin-script Mongolian, folded to one form
+LATIN_FOLDS = [('kh', 'h'), ('ts', 'c'), ('w', 'v'), ('q', 'o'), ('ii', 'i'), ('yi', 'i')]
+
+def search_key(word):
+    """Fold a word so Cyrillic and Latin spellings of it compare equal"""
+    word = word.casefold().translate(CYRILLIC_TO_LATIN)
+    for spelling, folded in LATIN_FOLDS:
+        word = word.replace(spelling, folded)
+    return word
+
+def trigrams(key):
+    padded = f" {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class CatalogSearch:
+    """In-memory search over the catalog for inline queries.
+
+    Words from title, title_name, cast, genre and description are folded
+    with search_key and indexed by every prefix (for search-as-you-type)
+    and by trigrams (for typos and spelling variants). The index is rebuilt
+    whenever catalog.revision changes, which only happens when the catalog
+    does.
+    """
+
+    # Weight of a match in each field
+    FIELDS = {'title': 3, 'title_name': 3, 'cast': 2, 'genre': 2, 'description': 1}
+    MIN_TRIGRAM_OVERLAP = 0.5
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._revision = None
+
+    def _build(self):
+        self._prefixes = {}  # prefix -> {name: weight}
+        self._trigrams = {}  # trigram -> {word key}
+        self._words = {}     # word key -> {name: weight}
+        for name, video in self.catalog.items():
+            for field, weight in self.FIELDS.items():
+                text = str(video.get(field) or '')
+                if field == 'title':
+                    text = text.replace('-', ' ')
+                for word in SEARCH_TOKEN.findall(text):
+                    key = search_key(word)
+                    names = self._words.setdefault(key, {})
+                    names[name] = max(names.get(name, 0), weight)
+        for key, names in self._words.items():
+            for i in range(1, len(key) + 1):
+                matches = self._prefixes.setdefault(key[:i], {})
+                for name, weight in names.items():
+                    matches[name] = max(matches.get(name, 0), weight)
+            for trigram in trigrams(key):
+                self._trigrams.setdefault(trigram, set()).add(key)
+        self._revision = self.catalog.revision
+
+    def refresh(self):
+        """Rebuild the index if the catalog changed since it was built"""
+        if self._revision != self.catalog.revision:
+            self._build()
+
+    def _match(self, key):
+        """{name: score} for one query word"""
+        self.refresh()
+        scores = {name: weight * 2 for name, weight in self._prefixes.get(key, {}).items()}
+        if len(key) >= 3:
+            # Fuzzy: indexed words sharing most of the query's trigrams
+            query_trigrams = trigrams(key)
+            counts = Counter()
+            for trigram in query_trigrams:
+                counts.update(self._trigrams.get(trigram, ()))
+            for word, shared in counts.items():
+                overlap = shared / len(query_trigrams | trigrams(word))
+                if overlap < self.MIN_TRIGRAM_OVERLAP:
+                    continue
+                for name, weight in self._words[word].items():
+                    scores[name] = max(scores.get(name, 0), weight * overlap)
+        return scores
+
+    def search(self, query, limit=50):
+        """Video names best matching query, best first"""
+        keys = [search_key(word) for word in SEARCH_TOKEN.findall(query)]
+        if not keys:
+            return self.catalog.newest(limit)
+        totals = None
+        for key in keys:
+            scores = self._match(key)
+            if totals is None:
+                totals = scores
+            else:
+                # Every word has to match something
+                totals = {name: total + scores[name] for name, total in totals.items() if name in scores}
+        # Ties go to the better rated, then the more recently added title
+        ranked = sorted(
+            totals,
+            key=lambda name: (
+                totals[name],
+                self.catalog.get(name).get('rating') or 0,
+                str(self.catalog.get(name).get('date_added') or ''),
+            ),
+            reverse=True,
+        )
+        return ranked[:limit]
+
+catalog_search = CatalogSearch(catalog)
+
+class BalanceLedger:
+    """Append-only double-entry ledger of balance movements.
+
+    Each entry moves a non-negative amount from its "debit" account to its
+    "credit" account: either a user id or one of the system accounts in
+    LEDGER_CONTRA. An account's balance is what it was credited minus what
+    it was debited, so all accounts together always sum to zero.
+
+    Entries are appended to ledger.jsonl as they happen; post_many() writes
+    several as one batch, and replay applies a batch only if all of its
+    entries made it to disk. snapshot() stores
+    every balance along with the file offset it covers, and load() only
+    replays the entries after that offset. The per-account history behind
+    /ledger is read from the file the first time it is asked for.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'ledger.jsonl')
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.balances = {}
+        self.seq = 0
+        self._tail = 0  # entries written since the last snapshot
+        self._file = None
+        self._history = {}
+        self._history_built = False
+
+    def _read_lines(self, offset):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line after a crash; the rest is intact
+                    logger.warning(f"Skipping unreadable record in {self.path}")
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _read(self, offset=0):
+        """Entries from offset on, leaving out batches that were cut short"""
+        pending = []
+        for entry in self._read_lines(offset):
+            batch = entry.get('batch')  # [first seq, size]
+            if pending and (batch is None or batch != pending[0]['batch']):
+                logger.warning(f"Skipping incomplete batch {pending[0]['batch']} in {self.path}")
+                pending = []
+            if batch is None:
+                yield entry
+                continue
+            pending.append(entry)
+            if len(pending) == batch[1]:
+                yield from pending
+                pending = []
+        if pending:
+            logger.warning(f"Skipping incomplete batch {pending[0]['batch']} in {self.path}")
+
+    def _apply(self, entry):
+        amount = entry['amount']
+        self.balances[entry['debit']] = self.balances.get(entry['debit'], 0) - amount
+        self.balances[entry['credit']] = self.balances.get(entry['credit'], 0) + amount
+        self.seq = entry['seq']
+
+    def load(self):
+        """Balances of every account: the last snapshot plus the entries after it"""
+        offset = 0
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self.balances, self.seq, offset = snapshot['balances'], snapshot['seq'], snapshot['offset']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"Ignoring unreadable {self.snapshot_path}: {e}")
+            self.balances, self.seq = {}, 0
+        self._tail = 0
+        for entry in self._read(offset):
+            self._apply(entry)
+            self._tail += 1
+        return self.balances
+
+    def balance(self, account):
+        return self.balances.get(account, 0)
+
+    def post(self, kind, debit, credit, amount, ref=None):
+        """Append one movement and apply it to both accounts"""
+        return self.post_many([(kind, debit, credit, amount, ref)])[0]
+
+    def post_many(self, movements):
+        """Append (kind, debit, credit, amount, ref) movements as one batch"""
+        timestamp = datetime.now().isoformat()
+        entries = []
+        for kind, debit, credit, amount, ref in movements:
+            entry = {
+                'seq': self.seq + len(entries) + 1,
+                'timestamp': timestamp,
+                'kind': kind,
+                'debit': debit,
+                'credit': credit,
+                'amount': amount,
+            }
+            if ref is not None:
+                entry['ref'] = ref
+            if len(movements) > 1:
+                entry['batch'] = [self.seq + 1, len(movements)]
+            entries.append(entry)
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if self._file.tell() and not self._ends_with_newline():
+                # Keep the next entry off a line torn by a crash
+                self._file.write('\n')
+        self._file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self._file.flush()
+        for entry in entries:
+            self._apply(entry)
+            if self._history_built:
+                self._history.setdefault(entry['debit'], []).append(entry)
+                self._history.setdefault(entry['credit'], []).append(entry)
+        self._tail += len(entries)
+        return entries
+
+    def history(self, account):
+        """Every entry touching account, oldest first"""
+        if not self._history_built:
+            for entry in self._read():
+                self._history.setdefault(entry['debit'], []).append(entry)
+                self._history.setdefault(entry['credit'], []).append(entry)
+            self._history_built = True
+        return self._history.get(account, [])
+
+    def _checkpoint(self):
+        """Serialized snapshot of the current balances, or None if unchanged"""
+        if not self._tail:
+            return None
+        self._tail = 0
+        return json.dumps({
+            'seq': self.seq,
+            'offset': os.path.getsize(self.path),
+            'taken_at': datetime.now().isoformat(),
+            'balances': self.balances,
+        })
+
+    def _write_snapshot(self, text):
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def snapshot(self):
+        """Checkpoint all balances so the next load starts from here"""
+        text = self._checkpoint()
+        if text:
+            self._write_snapshot(text)
+
+    async def snapshot_async(self):
+        text = self._checkpoint()
+        if text:
+            try:
+                await asyncio.to_thread(self._write_snapshot, text)
+            except Exception:
+                # The entries stay in the tail until a snapshot succeeds
+                self._tail = max(self._tail, 1)
+                raise
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+balance_ledger = BalanceLedger(LEDGER_DIR)
+
+async def ledger_snapshot_job(context: CallbackContext):
+    """Periodic job checkpointing the balance ledger"""
     try:
-        with open(USER_BALANCES_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            # Convert old format to new format if needed
-            for user_id, value in data.items():
-                if isinstance(value, int):
-                    data[user_id] = {'balance': value, 'subscription': None}
-            return data
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_user_balances(balances):
-    """Save user balances to JSON file"""
-    with open(USER_BALANCES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(balances, f, indent=2)
+        await balance_ledger.snapshot_async()
+    except Exception as e:
+        logger.error(f"Error writing ledger snapshot: {e}")
+
+def _ledger_movement(user_id, kind, amount, ref=None):
+    """Ledger movement of amount into a user's balance (negative: out of it)"""
+    contra = LEDGER_CONTRA[kind]
+    if amount < 0:
+        return (kind, str(user_id), contra, -amount, ref)
+    return (kind, contra, str(user_id), amount, ref)
+
+def post_balance_movements(movements):
+    """Record (user_id, kind, amount, ref) movements as one ledger batch"""
+    entries = balance_ledger.post_many([_ledger_movement(*movement) for movement in movements])
+    drop_reports('ledger')
+    return entries
+
+def post_balance_movement(user_id, kind, amount, ref=None):
+    """Record amount moving into a user's balance (negative: out of it)"""
+    return post_balance_movements([(user_id, kind, amount, ref)])[0]
+
+def _replay_user_balances(data):
+    """Build the balances view from the ledger.
+
+    On the first run the balances in data (old int values included) are
+    carried over as opening entries; after that the ledger alone decides.
+    """
+    balance_ledger.load()
+    if not balance_ledger.seq and data:
+        post_balance_movements([
+            (user_id, 'opening', value if isinstance(value, int) else value.get('balance', DEFAULT_BALANCE), None)
+            for user_id, value in data.items()
+        ])
+        balance_ledger.snapshot()
+    return {
+        account: {'balance': balance}
+        for account, balance in balance_ledger.balances.items()
+        if not account.startswith('@')
+    }
+
+def load_user_balances():
+    """Current user balances, an in-memory view over the balance ledger.
+
+    user_balances.json is only read to import pre-ledger balances and is
+    never written back: the ledger and its snapshots are the only record.
+    """
+    return state_store.get(USER_BALANCES_FILE, migrate=_replay_user_balances)
 
 def get_user_balance(user_id):
     """Get a user's current balance"""
     balances = load_user_balances()
-    return balances.get(str(user_id), {}).get('balance', 5000)  # Default balance is 5000
+    return balances.get(str(user_id), {}).get('balance', DEFAULT_BALANCE)
+
+def _balance_record(balances, user_id_str):
+    """A user's balance record, opening the account with DEFAULT_BALANCE if new"""
+    if user_id_str not in balances:
+        post_balance_movement(user_id_str, 'opening', DEFAULT_BALANCE)
+        balances[user_id_str] = {'balance': DEFAULT_BALANCE}
+    return balances[user_id_str]
 
-def deduct_user_balance(user_id, amount):
+def deduct_user_balance(user_id, amount, kind='purchase', ref=None):
     """Deduct from user's balance"""
     balances = load_user_balances()
     user_id_str = str(user_id)
-    user_data = balances.setdefault(user_id_str, {'balance': 5000, 'subscription': None})
+    user_data = _balance_record(balances, user_id_str)
     if user_data['balance'] >= amount:
-        user_data['balance'] -= amount
-        save_user_balances(balances)
+        post_balance_movement(user_id_str, kind, -amount, ref)
+        user_data['balance'] = balance_ledger.balance(user_id_str)
+        audience_index.balance_changed(user_id_str, user_data['balance'])
         return True
     return False
 
-def add_user_balance(user_id, amount):
+def add_user_balance(user_id, amount, kind='topup', ref=None):
     """Add to user's balance"""
+    add_user_balances({user_id: amount}, kind, ref)
+
+def add_user_balances(credits, kind, ref=None):
+    """Credit several users ({user_id: amount}) in one step and one ledger batch"""
     balances = load_user_balances()
+    records = {str(user_id): _balance_record(balances, str(user_id)) for user_id in credits}
+    post_balance_movements([(user_id, kind, amount, ref) for user_id, amount in credits.items()])
+    for user_id_str, user_data in records.items():
+        user_data['balance'] = balance_ledger.balance(user_id_str)
+        audience_index.balance_changed(user_id_str, user_data['balance'])
+
+# Per-user locks; an entry disappears once nobody holds or waits on it
+_user_locks = weakref.WeakValueDictionary()
+
+def get_user_lock(user_id):
+    """Return the asyncio lock guarding one user's balance"""
     user_id_str = str(user_id)
-    user_data = balances.setdefault(user_id_str, {'balance': 5000, 'subscription': None})
-    user_data['balance'] += amount
-    save_user_balances(balances)
+    lock = _user_locks.get(user_id_str)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[user_id_str] = lock
+    return lock
+
+class BalanceTransaction:
+    """Balance changes for one user, made while holding that user's lock"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.deducted = 0
+        self._charges = []  # (amount, ref) deducted so far
+
+    @property
+    def balance(self):
+        return get_user_balance(self.user_id)
+
+    def deduct(self, amount, kind='purchase', ref=None):
+        """Deduct amount if the balance covers it"""
+        if not deduct_user_balance(self.user_id, amount, kind, ref):
+            return False
+        self.deducted += amount
+        self._charges.append((amount, ref))
+        return True
+
+    def credit(self, amount, kind='topup', ref=None):
+        add_user_balance(self.user_id, amount, kind, ref)
+
+    def refund(self):
+        """Give back everything deducted in this transaction"""
+        for amount, ref in self._charges:
+            add_user_balance(self.user_id, amount, 'refund', ref)
+        self.deducted = 0
+        self._charges = []
+
+@asynccontextmanager
+async def balance_transaction(user_id):
+    """Run a check/deduct/deliver sequence atomically for one user.
+
+    Other transactions for the same user wait until this one finishes, and
+    an exception escaping the block refunds whatever was deducted.
+    """
+    async with get_user_lock(user_id):
+        tx = BalanceTransaction(user_id)
+        try:
+            yield tx
+        except BaseException:
+            tx.refund()
+            raise
 
 def load_user_activity():
     """Load basic user info from file"""
-    try:
-        with open(USER_ACTIVITY_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    return state_store.get(USER_ACTIVITY_FILE)
     
 def save_user_activity(activity_data):
     """Save basic user info to file"""
-    with open(USER_ACTIVITY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(activity_data, f, indent=2)
+    state_store.put(USER_ACTIVITY_FILE, activity_data)
 
 def load_blocked_users():
     """Load blocked users from JSON file"""
-    try:
-        with open(BLOCKED_USERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    return state_store.get(BLOCKED_USERS_FILE)
 
 def save_blocked_users(blocked_users):
     """Save blocked users to JSON file"""
-    with open(BLOCKED_USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(blocked_users, f, indent=2)
+    state_store.put(BLOCKED_USERS_FILE, blocked_users)
+    # The /blocked report carries unblock buttons: never show a stale one
+    drop_reports('blocked')
 
 def is_user_blocked(user_id):
     """Check if user is blocked"""
@@ -168,75 +1511,20 @@ def block_user(user_id, username, first_name):
     }
     save_blocked_users(blocked_users)
 
-def record_user_activity(user_id, username, first_name, last_name, video_name):
-    """Update basic user info and log video delivery"""
-    # Update basic user info
-    activity_data = load_user_activity()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in activity_data:
-        activity_data[user_id_str] = {
-            'username': username,
-            'first_name': first_name,
-            'last_name': last_name,
-            'referral_code': user_id_str,
-            'referred_by': None,
-            'referrals': [],
-            'movies_watched': 0,
-            'referral_credits_earned': 0
-        }
-    
-    # Log the video delivery
-    save_user_activity(activity_data)
-
-def load_video_data():
-    """Load video metadata from movie-details.json file"""
-    try:
-        with open(MOVIE_DETAILS, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"Error loading movie-details.json: {e}")
-        return {}
-    
-def save_video_data(video_data):
-    """Save video metadata to movie-details.json file"""
-    with open(MOVIE_DETAILS, 'w', encoding='utf-8') as f:
-        json.dump(video_data, f, indent=2)
-
-def sync_video_data():
-    """
-    This function is simplified since we're only using one file now
-    Just ensures the video_db mapping is up to date
-    """
-    try:
-        video_data = load_video_data()
-        # Update video_db with current file_ids
-        global video_db
-        video_db = {title: data['file_id'] for title, data in video_data.items()}
-        return True
-    except Exception as e:
-        logger.error(f"Error syncing video data: {e}")
-        return False
-
 def log_user_message(user_id, username, first_name, text, chat_type):
     """Save user messages to chat_logs.json"""
-    logs = load_chat_logs()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in logs:
-        logs[user_id_str] = {
-            'username': username,
-            'first_name': first_name,
-            'messages': []
-        }
-    
-    logs[user_id_str]['messages'].append({
+    entry = {
         'timestamp': datetime.now().isoformat(),
         'text': text,
         'chat_type': chat_type
-    })
-    
-    save_chat_logs(logs)
+    }
+    state_store.append(
+        CHAT_LOG_FILE,
+        str(user_id),
+        entry,
+        header={'username': username, 'first_name': first_name}
+    )
+    message_index.add(str(user_id), entry)
 
 def unblock_user(user_id):
     """Unblock a user and reset their video count"""
@@ -250,125 +1538,197 @@ def unblock_user(user_id):
 
 def log_sent_video(user_id, video_name):
     """Log successfully sent videos in video_logs.json"""
-    logs = load_video_logs()
     user_id_str = str(user_id)
+    header = None
     
-    if user_id_str not in logs:
+    if user_id_str not in load_video_logs():
         # Get user info from user_activity if available
-        activity_data = load_user_activity()
-        user_data = activity_data.get(user_id_str, {})
-        
-        logs[user_id_str] = {
+        user_data = load_user_activity().get(user_id_str, {})
+        header = {
             'username': user_data.get('username', ''),
-            'first_name': user_data.get('first_name', ''),
-            'deliveries': []
+            'first_name': user_data.get('first_name', '')
         }
     
-    logs[user_id_str]['deliveries'].append({
-        'timestamp': datetime.now().isoformat(),
-        'video_name': video_name,
-        'status': 'sent'
-    })
+    entry = {'timestamp': datetime.now().isoformat()}
+    video_id = catalog.id_of(video_name)
+    if video_id is not None:
+        entry['video_id'] = video_id
+    else:
+        # Not a catalog title (e.g. the troubleshooting video)
+        entry['video_name'] = video_name
+    entry['status'] = 'sent'
     
-    save_video_logs(logs)
+    state_store.append(VIDEO_LOG_FILE, user_id_str, entry, header=header)
+    audience_index.watched(user_id_str, entry['timestamp'])
+    delivery_counters.add(entry)
+
+def delivery_video_name(delivery):
+    """Current name of the video a delivery log entry refers to"""
+    if 'video_id' in delivery:
+        return catalog.name_of(delivery['video_id']) or f"#{delivery['video_id']}"
+    return delivery['video_name']
+
+class DeliveryCounters:
+    """Delivery counts per title, per category and per day.
+
+    Built from the delivery log at startup, then bumped by
+    log_sent_video, so /videologs reads counters instead of recounting the
+    whole history. Titles are keyed by video id (by name for non-catalog
+    videos), so renames do not split a title's count.
+    """
+
+    def __init__(self):
+        self._built = False
+
+    def build(self):
+        self.by_title = Counter()
+        self.by_category = Counter()
+        self.by_day = {}  # 'YYYY-MM-DD' -> (Counter by title, Counter by category)
+        self._built = True
+        for data in load_video_logs().values():
+            for delivery in data.get('deliveries', []):
+                self.add(delivery)
+
+    def add(self, delivery):
+        if not self._built:
+            return
+        title = delivery.get('video_id', delivery.get('video_name'))
+        video = catalog.get(delivery_video_name(delivery)) or {}
+        category = video.get('category', 'other')
+        day = (delivery.get('timestamp') or '')[:10]
+        self.by_title[title] += 1
+        self.by_category[category] += 1
+        day_titles, day_categories = self.by_day.setdefault(day, (Counter(), Counter()))
+        day_titles[title] += 1
+        day_categories[category] += 1
+
+    def totals(self, days=None):
+        """(Counter by title, Counter by category) for the last days days, or all time"""
+        if not self._built:
+            self.build()
+        if days is None:
+            return self.by_title, self.by_category
+        titles, categories = Counter(), Counter()
+        today = datetime.now().date()
+        for offset in range(days):
+            day = (today - timedelta(days=offset)).isoformat()
+            if day in self.by_day:
+                titles.update(self.by_day[day][0])
+                categories.update(self.by_day[day][1])
+        return titles, categories
+
+    @staticmethod
+    def title_name(title):
+        if isinstance(title, int):
+            return catalog.name_of(title) or f"#{title}"
+        return title
+
+delivery_counters = DeliveryCounters()
+
+def upgrade_video_references():
+    """Replace slugs in delivery logs with video ids (one-off, at startup)"""
+    logs = load_video_logs()
+    upgraded = 0
+    for data in logs.values():
+        for delivery in data.get('deliveries', []):
+            if 'video_id' in delivery:
+                continue
+            video_id = catalog.id_of(delivery['video_name'])
+            if video_id is not None:
+                delivery['video_id'] = video_id
+                del delivery['video_name']
+                upgraded += 1
+    if upgraded:
+        # Rewrites (compacts) the delivery log once with the smaller records
+        state_store.mark_dirty(VIDEO_LOG_FILE)
+        logger.info(f"Replaced video names with ids in {upgraded} delivery records")
 
 def log_user_photo(user_id, username, first_name, photo_file_id, caption=None):
     """Save user photo submissions to photo_logs.json"""
-    logs = load_photo_logs()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in logs:
-        logs[user_id_str] = {
-            'username': username,
-            'first_name': first_name,
-            'photos': []
-        }
-    
-    logs[user_id_str]['photos'].append({
-        'timestamp': datetime.now().isoformat(),
-        'photo_file_id': photo_file_id,
-        'caption': caption
-    })
-    
-    save_photo_logs(logs)
+    state_store.append(
+        PHOTO_LOG_FILE,
+        str(user_id),
+        {
+            'timestamp': datetime.now().isoformat(),
+            'photo_file_id': photo_file_id,
+            'caption': caption
+        },
+        header={'username': username, 'first_name': first_name}
+    )
 
 def load_chat_logs():
     """Load chat logs from file"""
-    try:
-        with open(CHAT_LOG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_chat_logs(logs):
-    """Save chat logs to file"""
-    with open(CHAT_LOG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, indent=2)
+    return state_store.get(CHAT_LOG_FILE)
 
 def load_photo_logs():
     """Load photo logs from file"""
-    try:
-        with open(PHOTO_LOG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_photo_logs(logs):
-    """Save photo logs to file"""
-    with open(PHOTO_LOG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, indent=2)
+    return state_store.get(PHOTO_LOG_FILE)
 
 def load_video_logs():
     """Load video delivery logs from file"""
-    try:
-        with open(VIDEO_LOG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_video_logs(logs):
-    """Save video delivery logs to file"""
-    with open(VIDEO_LOG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, indent=2)
-
-def has_user_paid_for_video(user_id, video_name):
-    """Check if user has already paid for this video"""
-    video_logs = load_video_logs()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in video_logs:
-        return False
-    
-    # Check if this video has already been delivered to the user
-    for delivery in video_logs[user_id_str].get('deliveries', []):
-        if delivery['video_name'] == video_name:
-            return True
-    return False
+    return state_store.get(VIDEO_LOG_FILE)
 
-def get_user_subscription(user_id):
-    """Get user's active subscription"""
-    subscriptions = load_subscriptions()
+def load_purchases():
+    """Load purchased video ids per user ({user_id: [video_id, ...]}, plus PURCHASES_BACKFILLED)"""
+    return state_store.get(PURCHASES_FILE)
+
+# user_id -> set of purchased video ids, built from purchases on first use
+_purchase_index = None
+
+# Key in purchases.json recording that the one-time backfill has run
+PURCHASES_BACKFILLED = '_backfilled'
+
+def _backfill_purchases():
+    """Build purchases from delivery history (pre-purchases.json data)"""
+    purchases = {}
+    for user_id, data in load_video_logs().items():
+        video_ids = []
+        for delivery in data.get('deliveries', []):
+            video_id = delivery.get('video_id', catalog.id_of(delivery.get('video_name')))
+            if video_id is not None and video_id not in video_ids:
+                video_ids.append(video_id)
+        if video_ids:
+            purchases[user_id] = video_ids
+    return purchases
+
+def _get_purchase_index():
+    global _purchase_index
+    if _purchase_index is None:
+        purchases = load_purchases()
+        if PURCHASES_BACKFILLED not in purchases:
+            # Only data from before purchases.json needs it; an empty file later on
+            # must not turn subscription deliveries into purchases again
+            if not purchases:
+                purchases.update(_backfill_purchases())
+            purchases[PURCHASES_BACKFILLED] = datetime.now().isoformat()
+            state_store.mark_dirty(PURCHASES_FILE)
+        for user_id, owned in purchases.items():
+            if user_id == PURCHASES_BACKFILLED:
+                continue
+            if any(isinstance(video, str) for video in owned):
+                # Purchases recorded by slug before videos had ids
+                ids = [video if isinstance(video, int) else catalog.id_of(video) for video in owned]
+                purchases[user_id] = list(dict.fromkeys(i for i in ids if i is not None))
+                state_store.mark_dirty(PURCHASES_FILE)
+        _purchase_index = {user_id: set(owned) for user_id, owned in purchases.items()
+                           if user_id != PURCHASES_BACKFILLED}
+    return _purchase_index
+
+def record_purchase(user_id, video_name):
+    """Remember that user paid for video_name"""
+    video_id = catalog.id_of(video_name)
+    if video_id is None:
+        return
     user_id_str = str(user_id)
-    
-    if user_id_str not in subscriptions:
-        return None
-        
-    subscription = subscriptions[user_id_str]
-    end_date = datetime.fromisoformat(subscription['end_date'])
-    
-    # Check if subscription is still active
-    if datetime.now() < end_date:
-        return subscription
-    else:
-        # Subscription expired, remove it
-        del subscriptions[user_id_str]
-        save_subscriptions(subscriptions)
-        return None
+    owned = _get_purchase_index().setdefault(user_id_str, set())
+    if video_id in owned:
+        return
+    owned.add(video_id)
+    load_purchases().setdefault(user_id_str, []).append(video_id)
+    state_store.mark_dirty(PURCHASES_FILE)
 
 def activate_subscription(user_id, category, duration, bypass_balance_check=False):
-    """Activate a subscription for user"""
-    balances = load_user_balances()
-    subscriptions = load_subscriptions()
+    """Activate a subscription for user, or extend the active one in the same category"""
     user_id_str = str(user_id)
     
     if duration not in ['1_month', '3_months', '6_months']:
@@ -383,92 +1743,261 @@ def activate_subscription(user_id, category, duration, bypass_balance_check=Fals
         price = SUBSCRIPTION_PRICES[duration]['single']
 
     
-    # Get user balance (initialize if doesn't exist)
-    user_balance = balances.setdefault(user_id_str, {'balance': 5000}).get('balance', 5000)
-    
     # Only check balance if not bypassing (for admin commands)
-    if not bypass_balance_check and user_balance < price:
+    if not bypass_balance_check and get_user_balance(user_id_str) < price:
         return False
     
-    # Calculate start and end dates
-    start_date = datetime.now()
     months = int(duration.split('_')[0])
-    end_date = start_date + timedelta(days=30*months)
-    
-    # Create subscription record
-    subscription_data = {
-        'category': category,
-        'start_date': start_date.isoformat(),
-        'end_date': end_date.isoformat(),
+    grant, extended = entitlements.grant(user_id_str, category, timedelta(days=30*months), {
         'duration': duration,
         'price': price,
         'activated_by_admin': bypass_balance_check
-    }
-    
-    # Store subscription
-    subscriptions[user_id_str] = subscription_data
-    save_subscriptions(subscriptions)
+    })
     
     # Log the action
     log_subscription_action(
         user_id,
-        'activated',
+        'extended' if extended else 'activated',
         {
             'category': category,
             'duration': duration,
             'price': price,
-            'end_date': end_date.isoformat()
+            'end_date': grant['end_date']
         }
     )
     
     # Only deduct balance if not bypassing
     if not bypass_balance_check:
-        balances[user_id_str]['balance'] = user_balance - price
-        save_user_balances(balances)
+        deduct_user_balance(user_id_str, price, 'subscription', ref=f"sub:{category}:{duration}")
     
     return True
 
+def _migrate_subscriptions(data):
+    """Convert single-subscription records to grant lists (runs once per load)"""
+    for user_id, value in data.items():
+        if 'grants' not in value:
+            data[user_id] = {'grants': [value]}
+    return data
+
 def load_subscriptions():
     """Load active subscriptions from file"""
-    try:
-        with open(SUBSCRIPTIONS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    return state_store.get(SUBSCRIPTIONS_FILE, migrate=_migrate_subscriptions)
 
 def save_subscriptions(subscriptions):
     """Save active subscriptions to file"""
-    with open(SUBSCRIPTIONS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(subscriptions, f, indent=2)
+    state_store.put(SUBSCRIPTIONS_FILE, subscriptions)
 
 def load_subscription_logs():
     """Load subscription history logs"""
-    try:
-        with open(SUBSCRIPTION_LOGS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_subscription_logs(logs):
-    """Save subscription history logs"""
-    with open(SUBSCRIPTION_LOGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, indent=2)
+    return state_store.get(SUBSCRIPTION_LOGS_FILE)
 
 def log_subscription_action(user_id, action, details):
     """Record a subscription action in the logs"""
-    logs = load_subscription_logs()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in logs:
-        logs[user_id_str] = []
-    
-    logs[user_id_str].append({
-        'timestamp': datetime.now().isoformat(),
-        'action': action,
-        'details': details
-    })
-    
-    save_subscription_logs(logs)
+    state_store.append(
+        SUBSCRIPTION_LOGS_FILE,
+        str(user_id),
+        {
+            'timestamp': datetime.now().isoformat(),
+            'action': action,
+            'details': details
+        }
+    )
+
+# Video categories a subscription category unlocks besides its own ('all' unlocks everything)
+SUBSCRIPTION_COVERAGE = {'lgbtlex': ('lgbtlex', 'bl', 'gl')}
+
+class EntitlementEngine:
+    """Which categories each user can watch through subscriptions.
+
+    A user can hold several grants at once (say animelex and movielex),
+    each a start_date/end_date interval stored under the user's "grants" in
+    subscriptions.json. For lookups a user's grants are compiled into a
+    {video category: expiry} map that is cached until those grants change,
+    so can_watch is a couple of dict lookups.
+    """
+
+    def __init__(self):
+        self._compiled = {}  # user_id -> {category: expiry}
+
+    def grants(self, user_id):
+        entry = load_subscriptions().get(str(user_id))
+        return entry['grants'] if entry else []
+
+    def _compile(self, user_id):
+        compiled = {}
+        for grant in self.grants(user_id):
+            end = datetime.fromisoformat(grant['end_date'])
+            for category in SUBSCRIPTION_COVERAGE.get(grant['category'], (grant['category'],)):
+                if end > compiled.get(category, datetime.min):
+                    compiled[category] = end
+        return compiled
+
+    def expiry(self, user_id, video_category):
+        """When the user's access to video_category ends (datetime.min if none)"""
+        user_id = str(user_id)
+        compiled = self._compiled.get(user_id)
+        if compiled is None:
+            compiled = self._compiled[user_id] = self._compile(user_id)
+        return max(compiled.get(video_category, datetime.min), compiled.get('all', datetime.min))
+
+    def can_watch(self, user_id, video_category):
+        return self.expiry(user_id, video_category) > datetime.now()
+
+    def grant(self, user_id, category, length, details):
+        """Give length (a timedelta) of access to category; returns (grant, extended).
+
+        An active grant in the same category is extended (the new period is
+        stacked onto its end); otherwise a new grant starts now.
+        """
+        user_id = str(user_id)
+        subscriptions = load_subscriptions()
+        grants = subscriptions.setdefault(user_id, {'grants': []})['grants']
+        now = datetime.now()
+        grant = next((g for g in grants
+                      if g['category'] == category and datetime.fromisoformat(g['end_date']) > now), None)
+        extended = grant is not None
+        if extended:
+            grant['end_date'] = (datetime.fromisoformat(grant['end_date']) + length).isoformat()
+            grant.update({
+                **details,
+                'price': grant.get('price', 0) + details.get('price', 0),
+                'extended_at': now.isoformat(),
+            })
+            grant.pop('reminders_sent', None)
+        else:
+            grant = {
+                'category': category,
+                'start_date': now.isoformat(),
+                'end_date': (now + length).isoformat(),
+                **details
+            }
+            grants.append(grant)
+        save_subscriptions(subscriptions)
+        self.changed(user_id)
+        subscription_scheduler.add(user_id, grant)
+        return grant, extended
+
+    def revoke(self, user_id, grant):
+        """Remove one grant (e.g. when it ends)"""
+        user_id = str(user_id)
+        subscriptions = load_subscriptions()
+        grants = subscriptions.get(user_id, {}).get('grants', [])
+        if grant in grants:
+            grants.remove(grant)
+            if not grants:
+                del subscriptions[user_id]
+            save_subscriptions(subscriptions)
+            self.changed(user_id)
+
+    def changed(self, user_id):
+        self._compiled.pop(user_id, None)
+        audience_index.grants_changed(user_id, self.grants(user_id))
+
+entitlements = EntitlementEngine()
+
+# Renewal reminders, sent this long before a subscription ends
+SUBSCRIPTION_REMINDERS = {'3d': timedelta(days=3), '1d': timedelta(days=1)}
+
+class SubscriptionScheduler:
+    """Retires subscription grants at their end_date and sends renewal reminders.
+
+    Expiry and reminder events sit in a min-heap loaded at startup; one
+    job_queue job is kept scheduled for the earliest event. Events of a
+    grant that was since extended or removed are skipped when they come up,
+    so nothing has to be removed from the heap.
+    """
+
+    def __init__(self):
+        self._heap = []  # (time, kind, user_id, category, end_date)
+        self._job_queue = None
+        self._job = None
+        self._next_at = None
+
+    def start(self, job_queue):
+        self._job_queue = job_queue
+        now = datetime.now()
+        for user_id, entry in load_subscriptions().items():
+            for grant in entry['grants']:
+                self._push(user_id, grant, now)
+        self._reschedule()
+
+    def add(self, user_id, grant):
+        """Track a new or extended grant"""
+        if self._job_queue is None:
+            return
+        self._push(user_id, grant, datetime.now())
+        self._reschedule()
+
+    def _push(self, user_id, grant, now):
+        category, end_date = grant['category'], grant['end_date']
+        end = datetime.fromisoformat(end_date)
+        heapq.heappush(self._heap, (end, 'expire', user_id, category, end_date))
+        sent = grant.get('reminders_sent', [])
+        for kind, before in SUBSCRIPTION_REMINDERS.items():
+            closer_due = any(end - b <= now for b in SUBSCRIPTION_REMINDERS.values() if b < before)
+            # After downtime only the most urgent missed reminder is sent
+            if kind not in sent and not closer_due:
+                heapq.heappush(self._heap, (end - before, kind, user_id, category, end_date))
+
+    def _reschedule(self):
+        if not self._heap:
+            return
+        at = self._heap[0][0]
+        if self._next_at is not None and self._next_at <= at:
+            return
+        if self._job:
+            self._job.schedule_removal()
+        self._next_at = at
+        self._job = self._job_queue.run_once(
+            self._run,
+            when=max(0.0, (at - datetime.now()).total_seconds()),
+            name='subscription_expiry'
+        )
+
+    async def _run(self, context: CallbackContext):
+        self._job = self._next_at = None
+        now = datetime.now()
+        reminded = False
+        reminders = {}  # message -> user ids
+        while self._heap and self._heap[0][0] <= now:
+            _, kind, user_id, category, end_date = heapq.heappop(self._heap)
+            grant = next((g for g in entitlements.grants(user_id)
+                          if g['category'] == category and g['end_date'] == end_date), None)
+            if grant is None:
+                continue  # extended or removed since
+            if kind == 'expire':
+                entitlements.revoke(user_id, grant)
+                log_subscription_action(user_id, 'expired', {
+                    'category': category,
+                    'duration': grant['duration'],
+                    'end_date': end_date
+                })
+                continue
+            end = datetime.fromisoformat(end_date)
+            sent = grant.setdefault('reminders_sent', [])
+            if kind in sent or end <= now:
+                continue
+            # This reminder also stands in for any earlier one not sent yet
+            sent.extend(k for k, b in SUBSCRIPTION_REMINDERS.items()
+                        if b >= SUBSCRIPTION_REMINDERS[kind] and k not in sent)
+            reminded = True
+            days = max(1, math.ceil((end - now) / timedelta(days=1)))
+            message = (
+                f"⏰ Таны {category} багцын хугацаа {days} хоногийн дараа "
+                f"({end.strftime('%Y-%m-%d')}) дуусна.\n\n"
+                "Сунгахыг хүсвэл төлбөрөө шилжүүлээд дэлгэцийн зургаа ийшээ явуулна уу."
+            )
+            reminders.setdefault(message, []).append(user_id)
+        if reminded:
+            state_store.mark_dirty(SUBSCRIPTIONS_FILE)
+        self._reschedule()
+
+        # Same text for everyone in a group: send each group as a small broadcast
+        for message, user_ids in reminders.items():
+            results = await BroadcastEngine(context.bot, message, user_ids).run()
+            logger.info(f"Sent subscription reminders: {dict(results)}")
+
+subscription_scheduler = SubscriptionScheduler()
 
 def update_user_activity(user_id, updates):
     """Update specific fields in user activity"""
@@ -487,35 +2016,122 @@ def update_user_activity(user_id, updates):
             'movies_watched': 0,
             'referral_credits_earned': 0
         }
+        audience_index.user_added(user_id_str)
     
     # Apply updates
     for key, value in updates.items():
         activity_data[user_id_str][key] = value
     
     save_user_activity(activity_data)
+    if 'referred_by' in updates:
+        audience_index.referred(user_id_str, updates['referred_by'])
+        referral_engine.invalidate(user_id_str)
     return activity_data[user_id_str]
 
-def get_referral_chain(user_id):
-    """Get the referral chain (u1 -> u2 -> u3) for a user"""
-    activity_data = load_user_activity()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in activity_data or not activity_data[user_id_str].get('referred_by'):
-        return []
-    
-    chain = []
-    current_user = user_id_str
-    
-    while True:
-        if current_user not in activity_data:
-            break
-        referred_by = activity_data[current_user].get('referred_by')
-        if not referred_by:
-            break
-        chain.append(referred_by)
-        current_user = referred_by
-    
-    return chain
+# Every REFERRAL_MILESTONE movies a user watches, they get REFERRAL_SELF_BONUS,
+# their referrer the first bonus and everyone further up the chain the second
+REFERRAL_MILESTONE = 5
+REFERRAL_SELF_BONUS = 1000
+REFERRAL_BONUSES = (300, 100)
+
+class ReferralEngine:
+    """Referral chains (referrer, their referrer, ...) and milestone bonuses.
+
+    A user's chain is cached after the first walk up the referred_by links,
+    reusing the cached chain of the first ancestor that has one. Links are
+    only created through link(), which refuses one that would make a user
+    their own ancestor; the cache entries it affects are dropped by
+    update_user_activity. A cycle already present in the data ends the
+    walk at the first repeated user.
+    """
+
+    def __init__(self):
+        self._chains = {}  # user_id -> tuple of ancestors, nearest first
+
+    def chain(self, user_id):
+        user_id_str = str(user_id)
+        chain = self._chains.get(user_id_str)
+        if chain is not None:
+            return chain
+        activity_data = load_user_activity()
+        ancestors = []
+        seen = {user_id_str}
+        current = user_id_str
+        while True:
+            if current != user_id_str and current in self._chains:
+                rest = self._chains[current]
+                if seen.isdisjoint(rest):
+                    ancestors.extend(rest)
+                    break
+                # A cycle that formed behind the cache: walk it by hand
+            referrer = activity_data.get(current, {}).get('referred_by')
+            if not referrer:
+                break
+            if referrer in seen:
+                logger.warning(f"Referral cycle through user {referrer}; chain of {user_id_str} stops there")
+                break
+            ancestors.append(referrer)
+            seen.add(referrer)
+            current = referrer
+        chain = self._chains[user_id_str] = tuple(ancestors)
+        return chain
+
+    def invalidate(self, user_id):
+        """Forget the chains of user_id and of everyone below them"""
+        user_id_str = str(user_id)
+        self._chains.pop(user_id_str, None)
+        for user, chain in list(self._chains.items()):
+            if user_id_str in chain:
+                del self._chains[user]
+
+    def link(self, user, referrer_id):
+        """Record that user joined through referrer_id; False if that is not allowed"""
+        activity_data = load_user_activity()
+        user_id_str = str(user.id)
+        # Only users who were not referred yet, by someone we know
+        if activity_data.get(user_id_str, {}).get('referred_by'):
+            return False
+        if referrer_id not in activity_data or referrer_id == user_id_str:
+            return False
+        if user_id_str in self.chain(referrer_id):
+            logger.warning(f"Ignoring referral of {user_id_str} by {referrer_id}: it would form a cycle")
+            return False
+
+        update_user_activity(user.id, {
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'referred_by': referrer_id
+        })
+        referrals = activity_data[referrer_id].setdefault('referrals', [])
+        if user_id_str not in referrals:
+            referrals.append(user_id_str)
+            update_user_activity(int(referrer_id), {'referrals': referrals})
+        return True
+
+    def award_milestone(self, user_id):
+        """Credit every bonus owed for the user's latest watch; returns {user_id: amount}"""
+        activity_data = load_user_activity()
+        user_id_str = str(user_id)
+        watched = activity_data.get(user_id_str, {}).get('movies_watched', 0)
+        if not watched or watched % REFERRAL_MILESTONE:
+            return {}
+
+        credits = {}
+        for position, referrer_id in enumerate(self.chain(user_id_str)):
+            if referrer_id in activity_data:
+                credits[referrer_id] = REFERRAL_BONUSES[min(position, len(REFERRAL_BONUSES) - 1)]
+        credits[user_id_str] = REFERRAL_SELF_BONUS
+
+        # Nothing awaits in between, so no other update sees half of the batch
+        for credited_id, amount in credits.items():
+            credited = activity_data[credited_id]
+            credited['referral_credits_earned'] = credited.get('referral_credits_earned', 0) + amount
+        save_user_activity(activity_data)
+        add_user_balances(credits, 'referral_bonus', ref=f"referral:{user_id_str}:{watched}")
+        return credits
+
+referral_engine = ReferralEngine()
 
 async def forward_to_admin(update: Update, context: CallbackContext, text: str = None):
     """Forward user message to admin"""
@@ -619,60 +2235,29 @@ async def referral_stats(update: Update, context: CallbackContext) -> None:
     
     await update.message.reply_text('\n'.join(message))
 
-async def process_referral_credits(user_id, context: CallbackContext):
-    """Calculate and distribute referral credits when a user watches 5 movies"""
-    activity_data = load_user_activity()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in activity_data:
-        return
-    
-    user_data = activity_data[user_id_str]
-    
-    # Only process when user reaches 5 movies watched
-    if user_data.get('movies_watched', 0) % 5 != 0:
-        return
-    
-    referral_chain = get_referral_chain(user_id)
-    
-    # Distribute credits based on position in referral chain
-    for position, referrer_id in enumerate(referral_chain):
-        if referrer_id not in activity_data:
-            continue
-            
-        # Calculate credit amount based on position
-        if position == 0:  # Direct referrer gets 500
-            credit_amount = 300
-        else:  # Higher levels get 100
-            credit_amount = 100
-            
-        # Update referrer's credits
-        activity_data[referrer_id]['referral_credits_earned'] = activity_data[referrer_id].get('referral_credits_earned', 0) + credit_amount
-        add_user_balance(int(referrer_id), credit_amount)
-        
-        # Notify referrer
-        try:
-            await context.bot.send_message(
-                chat_id=int(referrer_id),
-                text=f"🎉 Та {credit_amount} төгрөг бонус хүлээн авлаа! {user_data.get('first_name')} таны уриалсан хэрэглэгч 5 кино үзсэн."
-            )
-        except Exception as e:
-            logger.error(f"Could not notify referrer {referrer_id}: {e}")
-    
-    # Give 1000 to the new user themselves
-    activity_data[user_id_str]['referral_credits_earned'] = activity_data[user_id_str].get('referral_credits_earned', 0) + 1000
-    add_user_balance(int(user_id_str), 1000)
-
-    # Notify the new user about their bonus
+async def _notify_referral_bonus(bot, user_id, text):
     try:
-        await context.bot.send_message(
-            chat_id=int(user_id_str),
-            text=f"🎉 Та 1000 төгрөг бонус хүлээн авлаа! Та 5 кино үзсэн."
-        )
+        await bot.send_message(chat_id=int(user_id), text=text)
     except Exception as e:
-        logger.error(f"Could not notify new user {user_id_str}: {e}")
-    
-    save_user_activity(activity_data)
+        logger.error(f"Could not notify {user_id} about a referral bonus: {e}")
+
+async def process_referral_credits(user_id, context: CallbackContext):
+    """Distribute referral credits each time a user watches another 5 movies"""
+    user_id_str = str(user_id)
+    credits = referral_engine.award_milestone(user_id_str)
+    if not credits:
+        return
+
+    first_name = load_user_activity()[user_id_str].get('first_name')
+    notifications = []
+    for credited_id, amount in credits.items():
+        if credited_id == user_id_str:
+            text = f"🎉 Та {amount} төгрөг бонус хүлээн авлаа! Та {REFERRAL_MILESTONE} кино үзсэн."
+        else:
+            text = (f"🎉 Та {amount} төгрөг бонус хүлээн авлаа! {first_name} таны уриалсан хэрэглэгч "
+                    f"{REFERRAL_MILESTONE} кино үзсэн.")
+        notifications.append(_notify_referral_bonus(context.bot, credited_id, text))
+    await asyncio.gather(*notifications)
 
 async def referral(update: Update, context: CallbackContext) -> None:
     """Handle /referral command to show user's referral link and stats"""
@@ -758,52 +2343,102 @@ async def subscription_history(update: Update, context: CallbackContext) -> None
         logger.error(f"Error viewing subscription history: {e}")
         await update.message.reply_text("An error occurred while fetching history.")
 
+# Admin reports are built once, kept for REPORT_TTL seconds and sent a page at a time
+REPORT_TTL = 60
+REPORT_PAGE_CHARS = 3500  # Telegram's limit is 4096 per message
+
+class Report:
+    """Rows of an admin report, split into pages that each fit one message"""
+
+    def __init__(self, title, rows, buttons=None, footer=None, empty="Nothing to show."):
+        self.title = title
+        self.rows = [row[:REPORT_PAGE_CHARS] for row in rows]
+        self.buttons = buttons or [None] * len(rows)  # optional button per row
+        self.footer = footer
+        self.empty = empty
+        self.created_at = time.monotonic()
+        self.pages = self._paginate()
+
+    def _paginate(self):
+        pages = []
+        start = size = 0
+        for i, row in enumerate(self.rows):
+            if i > start and size + len(row) > REPORT_PAGE_CHARS:
+                pages.append((start, i))
+                start, size = i, 0
+            size += len(row) + 1
+        pages.append((start, len(self.rows)))
+        return pages
+
+    def render(self, name, args, page):
+        """Text and keyboard for one page"""
+        if not self.rows:
+            return self.empty, None
+        page = max(1, min(page, len(self.pages)))
+        start, end = self.pages[page - 1]
+        title = self.title if len(self.pages) == 1 else f"{self.title} ({page}/{len(self.pages)})"
+        lines = [title, *self.rows[start:end]]
+        if self.footer and page == len(self.pages):
+            lines.append(self.footer)
+        keyboard = [[button] for button in self.buttons[start:end] if button]
+        if len(self.pages) > 1:
+            arg_text = ' '.join(args)
+            keyboard.append([
+                InlineKeyboardButton("◀️", callback_data=f"rp_{name}_{page - 1 if page > 1 else len(self.pages)}_{arg_text}"),
+                InlineKeyboardButton(f"{page}/{len(self.pages)}", callback_data="noop"),
+                InlineKeyboardButton("▶️", callback_data=f"rp_{name}_{page + 1 if page < len(self.pages) else 1}_{arg_text}"),
+            ])
+        return '\n'.join(lines), InlineKeyboardMarkup(keyboard) if keyboard else None
+
+# (report name, args) -> Report
+_reports = {}
+
+def get_report(name, args=()):
+    """Cached report, rebuilt when older than REPORT_TTL"""
+    key = (name, tuple(args))
+    report = _reports.get(key)
+    if report is None or time.monotonic() - report.created_at > REPORT_TTL:
+        report = _reports[key] = REPORT_BUILDERS[name](*args)
+    return report
+
+def drop_reports(name):
+    for key in [key for key in _reports if key[0] == name]:
+        del _reports[key]
+
+async def reply_report(update: Update, name, args=()):
+    text, reply_markup = get_report(name, args).render(name, args, 1)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+def build_subscriptions_report():
+    activity_data = load_user_activity()
+    now = datetime.now()
+    rows = []
+    # Already ordered by end date, i.e. by days remaining
+    for end_date, user_id, category in audience_index.active_subscriptions():
+        sub = next((g for g in entitlements.grants(user_id)
+                    if g['category'] == category and g['end_date'] == end_date), None)
+        if not sub:
+            continue
+        user_info = activity_data.get(user_id, {})
+        rows.append(
+            f"\n👤 User: {user_info.get('first_name', 'N/A')} (@{user_info.get('username', 'N/A')}, ID: {user_id})\n"
+            f"📌 Category: {sub['category']}\n"
+            f"⏳ Duration: {sub['duration']}\n"
+            f"💰 Price: {sub['price']}\n"
+            f"📅 Start: {datetime.fromisoformat(sub['start_date']).strftime('%Y-%m-%d')}\n"
+            f"📅 End: {datetime.fromisoformat(sub['end_date']).strftime('%Y-%m-%d')}\n"
+            f"⏱️ Days left: {(datetime.fromisoformat(sub['end_date']) - now).days}\n"
+            f"🛠️ Activated by admin: {'Yes' if sub.get('activated_by_admin') else 'No'}"
+        )
+    return Report("📋 Active Subscriptions:", rows, empty="No active subscriptions found.")
+
 async def view_subscriptions(update: Update, context: CallbackContext) -> None:
     """View all active subscriptions (admin only)"""
     if not is_admin(update):
         await update.message.reply_text("Зөвхөн админ.")
         return
     
-    subscriptions = load_subscriptions()
-    now = datetime.now()
-    active_subs = []
-    
-    for user_id, sub_data in subscriptions.items():
-        end_date = datetime.fromisoformat(sub_data['end_date'])
-        if now < end_date:  # Only show active subscriptions
-            # Get user info from activity logs
-            activity_data = load_user_activity()
-            user_info = activity_data.get(user_id, {})
-            
-            active_subs.append({
-                'user_id': user_id,
-                'username': user_info.get('username', 'N/A'),
-                'first_name': user_info.get('first_name', 'N/A'),
-                'subscription': sub_data,
-                'days_left': (end_date - now).days
-            })
-    
-    if not active_subs:
-        await update.message.reply_text("No active subscriptions found.")
-        return
-    
-    # Sort by days remaining
-    active_subs.sort(key=lambda x: x['days_left'])
-    
-    message = ["📋 Active Subscriptions:"]
-    for sub in active_subs:
-        message.append(
-            f"\n👤 User: {sub['first_name']} (@{sub['username']}, ID: {sub['user_id']})\n"
-            f"📌 Category: {sub['subscription']['category']}\n"
-            f"⏳ Duration: {sub['subscription']['duration']}\n"
-            f"💰 Price: {sub['subscription']['price']}\n"
-            f"📅 Start: {datetime.fromisoformat(sub['subscription']['start_date']).strftime('%Y-%m-%d')}\n"
-            f"📅 End: {datetime.fromisoformat(sub['subscription']['end_date']).strftime('%Y-%m-%d')}\n"
-            f"⏱️ Days left: {sub['days_left']}\n"
-            f"🛠️ Activated by admin: {'Yes' if sub['subscription'].get('activated_by_admin') else 'No'}"
-        )
-    
-    await update.message.reply_text('\n'.join(message))
+    await reply_report(update, 'subscriptions')
 
 async def set_subscription(update: Update, context: CallbackContext) -> None:
     """Set subscription for a user (admin only)"""
@@ -840,7 +2475,10 @@ async def set_subscription(update: Update, context: CallbackContext) -> None:
         duration = f"{months}_month{'s' if months > 1 else ''}"
         
         # Activate subscription with balance check bypass for admin
-        if activate_subscription(user_id, category, duration, bypass_balance_check=True):
+        async with get_user_lock(user_id):
+            activated = activate_subscription(user_id, category, duration, bypass_balance_check=True)
+
+        if activated:
             await update.message.reply_text(
                 f"✅ Subscription activated for user {user_id}:\n"
                 f"Category: {category}\n"
@@ -880,7 +2518,8 @@ async def add_balance(update: Update, context: CallbackContext) -> None:
         user_id = int(context.args[0])
         amount = int(context.args[1])
         
-        add_user_balance(user_id, amount)
+        async with balance_transaction(user_id) as tx:
+            tx.credit(amount, ref=f"admin:{update.effective_user.id}")
         
         await update.message.reply_text(
             f"✅ Added {amount} to user {user_id}. New balance: {get_user_balance(user_id)}"
@@ -900,6 +2539,128 @@ async def add_balance(update: Update, context: CallbackContext) -> None:
     except ValueError:
         await update.message.reply_text("Invalid user ID or amount. Must be numbers.")
 
+def build_ledger_report(user_id):
+    """A user's balance movements, newest first, with the balance after each"""
+    user_info = load_user_activity().get(user_id, {})
+    rows = []
+    balance = 0
+    for entry in balance_ledger.history(user_id):
+        change = entry['amount'] if entry['credit'] == user_id else -entry['amount']
+        balance += change
+        ref = f" ({entry['ref']})" if entry.get('ref') else ""
+        rows.append(f"#{entry['seq']} {entry['timestamp'][:16]} {entry['kind']}{ref}: {change:+} → {balance}")
+    rows.reverse()
+    return Report(
+        f"📒 Ledger of {user_info.get('first_name', 'N/A')} (ID: {user_id}):",
+        rows,
+        footer=f"\nBalance: {get_user_balance(user_id)}",
+        empty=f"No balance movements for user {user_id}."
+    )
+
+async def ledger_command(update: Update, context: CallbackContext) -> None:
+    """Page through a user's balance movements (admin only)"""
+    if not is_admin(update):
+        await update.message.reply_text("Admin only.")
+        return
+
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        await update.message.reply_text("Usage: /ledger <user_id>")
+        return
+
+    load_user_balances()  # replays the ledger on first use
+    await reply_report(update, 'ledger', (context.args[0],))
+
+# Telegram albums hold at most 10 items; /userphotos shows a few albums per page
+ALBUM_SIZE = 10
+USER_PHOTOS_PAGE_SIZE = 30
+
+def _photo_caption(photo):
+    caption = f"Timestamp: {photo['timestamp']}\nCaption: {photo.get('caption') or 'None'}"
+    return caption[:1024]
+
+async def send_user_photos(bot, chat_id, user_id, page=1, start=None, end=None):
+    """Send one page of a user's photos (newest first) as albums"""
+    photos = load_photo_logs().get(str(user_id), {}).get('photos', [])
+    if start or end:
+        # Timestamps are ISO strings, so dates compare as prefixes
+        photos = [
+            p for p in photos
+            if (not start or p['timestamp'][:10] >= start) and (not end or p['timestamp'][:10] <= end)
+        ]
+    if not photos:
+        await bot.send_message(chat_id=chat_id, text=f"No photos found for user {user_id}.")
+        return
+
+    photos = photos[::-1]
+    pages = (len(photos) + USER_PHOTOS_PAGE_SIZE - 1) // USER_PHOTOS_PAGE_SIZE
+    page = max(1, min(page, pages))
+    page_photos = photos[(page - 1) * USER_PHOTOS_PAGE_SIZE:page * USER_PHOTOS_PAGE_SIZE]
+
+    date_range = f" ({start or '...'} – {end or '...'})" if start or end else ""
+    await bot.send_message(
+        chat_id=chat_id,
+        text=f"📸 Photos sent by user {user_id}{date_range}: page {page}/{pages}, {len(photos)} total"
+    )
+
+    for i in range(0, len(page_photos), ALBUM_SIZE):
+        album = page_photos[i:i + ALBUM_SIZE]
+        if len(album) > 1:
+            try:
+                await bot.send_media_group(
+                    chat_id=chat_id,
+                    media=[InputMediaPhoto(media=p['photo_file_id'], caption=_photo_caption(p)) for p in album]
+                )
+                continue
+            except RetryAfter:
+                raise
+            except Exception as e:
+                # One bad file_id fails the whole album: fall back to single photos
+                logger.error(f"Error sending photo album: {e}")
+        # Single leftovers (albums need 2+ items) or a failed album
+        for photo in album:
+            try:
+                await bot.send_photo(chat_id=chat_id, photo=photo['photo_file_id'], caption=_photo_caption(photo))
+            except Exception as e:
+                logger.error(f"Error sending photo: {e}")
+                await bot.send_message(chat_id=chat_id, text=f"Failed to send one of the photos. Error: {str(e)}")
+
+    if page < pages:
+        keyboard = [[InlineKeyboardButton(
+            "⏭ Older photos",
+            callback_data=f"uph_{user_id}_{page + 1}_{(start or '').replace('-', '')}_{(end or '').replace('-', '')}"
+        )]]
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"Page {page}/{pages}",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+def _parse_photo_date(value):
+    """YYYY-MM-DD or YYYYMMDD (from callback data) -> YYYY-MM-DD, '' -> None"""
+    if not value:
+        return None
+    return datetime.strptime(value.replace('-', ''), "%Y%m%d").strftime("%Y-%m-%d")
+
+def parse_user_photos_args(args):
+    """(start, end, page) from /userphotos args after the user id.
+
+    Dates are YYYY-MM-DD: one date is a start, two are start and end, and
+    a range is FROM..TO with either side left open ('..2024-01-31').
+    """
+    dates = []
+    pages = []
+    for arg in args:
+        if '..' in arg:
+            start, end = arg.split('..', 1)
+            dates.extend([_parse_photo_date(start), _parse_photo_date(end)])
+        elif '-' in arg:
+            dates.append(_parse_photo_date(arg))
+        else:
+            pages.append(int(arg))
+    start = dates[0] if dates else None
+    end = dates[1] if len(dates) > 1 else None
+    return start, end, pages[0] if pages else 1
+
 async def user_photos(update: Update, context: CallbackContext) -> None:
     """Show photos sent by a specific user (admin only)"""
     if not is_admin(update):
@@ -907,48 +2668,32 @@ async def user_photos(update: Update, context: CallbackContext) -> None:
         return
     
     if not context.args:
-        await update.message.reply_text("Usage: /userphotos <user_id>")
+        await update.message.reply_text(
+            "Usage: /userphotos <user_id> [from YYYY-MM-DD] [to YYYY-MM-DD] [page]\n"
+            "Ranges: FROM..TO, ..TO or FROM..\n"
+            "Example: /userphotos 12345678 2024-01-01 2024-01-31"
+        )
         return
     
     try:
         user_id = int(context.args[0])
-        photo_logs = load_photo_logs()
-        user_id_str = str(user_id)
-        
-        if user_id_str not in photo_logs:
-            await update.message.reply_text(f"No photos found for user {user_id}.")
-            return
-        
-        photos = photo_logs[user_id_str].get('photos', [])
-        if not photos:
-            await update.message.reply_text(f"No photos found for user {user_id}.")
-            return
-        
-        await update.message.reply_text(f"📸 Photos sent by user {user_id}:")
-        
-        for photo in photos:
-            try:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo['photo_file_id'],
-                    caption=f"Timestamp: {photo['timestamp']}\nCaption: {photo.get('caption', 'None')}"
-                )
-                await asyncio.sleep(1)  # Small delay to avoid rate limits
-            except Exception as e:
-                logger.error(f"Error sending photo: {e}")
-                await update.message.reply_text(f"Failed to send one of the photos. Error: {str(e)}")
+        start, end, page = parse_user_photos_args(context.args[1:])
+        await send_user_photos(
+            context.bot, update.effective_chat.id, user_id,
+            page=page, start=start, end=end
+        )
         
     except ValueError:
-        await update.message.reply_text("Invalid user ID. Must be a number.")
+        await update.message.reply_text("Invalid user ID, date or page. Dates are YYYY-MM-DD.")
     except Exception as e:
         logger.error(f"Error in user_photos: {e}")
         await update.message.reply_text(f"An error occurred: {str(e)}")
 
 async def balance(update: Update, context: CallbackContext) -> None:
     """Check user balance and subscription status"""
-    user = update.effective_user
-    balance = get_user_balance(user.id)
-    subscription = get_user_subscription(user.id)
+    user_context = get_user_context(context, update.effective_user)
+    balance = user_context.balance
+    subscriptions = user_context.subscriptions
     
     # Base message with balance
     message = [
@@ -960,7 +2705,7 @@ async def balance(update: Update, context: CallbackContext) -> None:
     ]
     
     # Add subscription info if active
-    if subscription:
+    for subscription in subscriptions:
         end_date = datetime.fromisoformat(subscription['end_date']).strftime('%Y-%m-%d')
         days_left = (datetime.fromisoformat(subscription['end_date']) - datetime.now()).days
         
@@ -973,42 +2718,494 @@ async def balance(update: Update, context: CallbackContext) -> None:
             f"• Үнэ: {subscription['price']}",
             f"• Хугацаа: {subscription['duration'].replace('_', ' ')}"
         ])
-    else:
+    if not subscriptions:
         message.append("\nℹ️ Таньд захиалсан багц байхгүй байна.")
     
     await update.message.reply_text('\n'.join(message))
 
-async def _send_broadcast(context: CallbackContext):
-    job = context.job
-    message = job.data['message']
-    activity_data = load_user_activity()
+# Segment terms given before a broadcast message, each as its own "to:" argument,
+# e.g. "to:sub:movielex to:balance<3000"
+SEGMENT_PREFIX = 'to:'
+SEGMENT_TERM = re.compile(r'^(sub(?::[\w,]+)?|balance<\d+|watched:\d+|referred(?::\d+)?)$')
+
+class AudienceIndex:
+    """Indexes that answer broadcast segment queries without scanning users.
+
+    Built from the stored data on first use, then kept current by the code
+    that changes subscriptions, balances, deliveries and referrals.
+    Time- and amount-based lookups are sorted lists searched with bisect.
+    """
+
+    def __init__(self):
+        self._built = False
+
+    def _build(self):
+        self._users = set(load_user_activity())
+        self._subscriptions = {}   # category -> sorted [(end_date, user_id)]
+        self._subscription_of = {} # user_id -> [(category, end_date)]
+        for user_id, entry in load_subscriptions().items():
+            self.grants_changed(user_id, entry['grants'], force=True)
+        self._balances = []        # sorted [(balance, user_id)]
+        self._balance_of = {}
+        for user_id, data in load_user_balances().items():
+            self.balance_changed(user_id, data.get('balance', DEFAULT_BALANCE), force=True)
+        self._last_watched = []    # sorted [(timestamp, user_id)]
+        self._last_watched_of = {}
+        for user_id, user_log in load_video_logs().items():
+            timestamps = [d['timestamp'] for d in user_log.get('deliveries', []) if d.get('timestamp')]
+            if timestamps:
+                self.watched(user_id, max(timestamps), force=True)
+        self._referrer_of = {}
+        self._referrals = {}       # referrer -> set of referred users
+        for user_id, data in load_user_activity().items():
+            if data.get('referred_by'):
+                self.referred(user_id, data['referred_by'], force=True)
+        self._built = True
+
+    def _ensure_built(self):
+        if not self._built:
+            self._build()
+
+    @staticmethod
+    def _remove(items, item):
+        index = bisect.bisect_left(items, item)
+        if index < len(items) and items[index] == item:
+            del items[index]
+
+    def _move(self, items, positions, user_id, key):
+        old = positions.pop(user_id, None)
+        if old is not None:
+            self._remove(items, (old, user_id))
+        if key is not None:
+            positions[user_id] = key
+            bisect.insort(items, (key, user_id))
+
+    def user_added(self, user_id):
+        if self._built:
+            self._users.add(user_id)
+
+    def grants_changed(self, user_id, grants, force=False):
+        if not (self._built or force):
+            return
+        for category, end_date in self._subscription_of.pop(user_id, []):
+            self._remove(self._subscriptions.get(category, []), (end_date, user_id))
+        if grants:
+            self._subscription_of[user_id] = [(g['category'], g['end_date']) for g in grants]
+            for grant in grants:
+                bisect.insort(self._subscriptions.setdefault(grant['category'], []),
+                              (grant['end_date'], user_id))
+
+    def balance_changed(self, user_id, balance, force=False):
+        if self._built or force:
+            self._move(self._balances, self._balance_of, user_id, balance)
+
+    def watched(self, user_id, timestamp, force=False):
+        if self._built or force:
+            self._move(self._last_watched, self._last_watched_of, user_id, timestamp)
+
+    def referred(self, user_id, referrer, force=False):
+        if not (self._built or force):
+            return
+        old = self._referrer_of.pop(user_id, None)
+        if old:
+            self._referrals.get(old, set()).discard(user_id)
+        if referrer:
+            self._referrer_of[user_id] = referrer
+            self._referrals.setdefault(referrer, set()).add(user_id)
+
+    def subscribers(self, categories=None):
+        """Users with an active subscription covering any of categories"""
+        if categories is None:
+            categories = list(self._subscriptions)
+        elif any(c in CATEGORIES for c in categories):
+            categories = list(categories) + ['all']
+        now = datetime.now().isoformat()
+        users = set()
+        for category in set(categories):
+            items = self._subscriptions.get(category, [])
+            users.update(user_id for _, user_id in items[bisect.bisect_right(items, (now, '')):])
+        return users
+
+    def active_subscriptions(self):
+        """(end_date, user_id, category) of every active grant, soonest to end first"""
+        self._ensure_built()
+        now = datetime.now().isoformat()
+        return list(heapq.merge(*(
+            [(end_date, user_id, category)
+             for end_date, user_id in items[bisect.bisect_right(items, (now, '')):]]
+            for category, items in self._subscriptions.items()
+        )))
+
+    def balance_below(self, amount):
+        users = {user_id for _, user_id in self._balances[:bisect.bisect_left(self._balances, (amount, ''))]}
+        if amount > DEFAULT_BALANCE:
+            # Users without a balance record have the default balance
+            users.update(self._users.difference(self._balance_of))
+        return users
+
+    def watched_since(self, since):
+        start = bisect.bisect_left(self._last_watched, (since.isoformat(), ''))
+        return {user_id for _, user_id in self._last_watched[start:]}
+
+    def referred_users(self, referrer=None):
+        if referrer is None:
+            return set(self._referrer_of)
+        return set(self._referrals.get(referrer, ()))
+
+    def resolve(self, terms):
+        """Users matching every segment term (all users if there are none)"""
+        self._ensure_built()
+        users = set(self._users)
+        for term in terms:
+            if term == 'sub':
+                users &= self.subscribers()
+            elif term.startswith('sub:'):
+                users &= self.subscribers(term[4:].split(','))
+            elif term.startswith('balance<'):
+                users &= self.balance_below(int(term[8:]))
+            elif term.startswith('watched:'):
+                users &= self.watched_since(datetime.now() - timedelta(days=int(term[8:])))
+            elif term == 'referred':
+                users &= self.referred_users()
+            elif term.startswith('referred:'):
+                users &= self.referred_users(term[9:])
+        return sorted(users)
+
+audience_index = AudienceIndex()
+
+def parse_segment(args):
+    """Split leading "to:<term>" args off command args: (terms, remaining args).
+
+    Raises ValueError for a "to:" argument that is not a known term.
+    """
+    terms = []
+    for arg in args:
+        if not arg.startswith(SEGMENT_PREFIX):
+            break
+        term = arg[len(SEGMENT_PREFIX):]
+        if not SEGMENT_TERM.match(term):
+            raise ValueError(f"Unknown segment term: {term}")
+        terms.append(term)
+    return terms, args[len(terms):]
+
+class TokenBucket:
+    """Rate limiter shared by all broadcast senders.
+
+    The rate backs off when Telegram answers with RetryAfter and creeps
+    back up to the configured rate while sends succeed.
+    """
+
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(1.0, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def flood_wait(self, seconds):
+        """Stop all senders for seconds and halve the sending rate"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.rate = max(1.0, self.rate / 2)
+
+    def success(self):
+        self.rate = min(self.max_rate, self.rate * 1.01)
 
-    success = 0
-    failed = 0
+# One bucket for every sender (admin broadcasts, subscription reminders), so
+# several running at once still share BROADCAST_RATE
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
 
-    for user_id_str in activity_data:
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+def _request_not_sent(error):
+    """True if a TimedOut/NetworkError failed before the request left the bot"""
+    return isinstance(error.__cause__, (httpx.PoolTimeout, httpx.ConnectTimeout, httpx.ConnectError))
+
+class BroadcastEngine:
+    """Send one message to many users with a bounded pool of senders.
+
+    Senders of every engine draw from the shared broadcast_bucket, so the
+    bot as a whole stays under Telegram's flood limits even with several
+    broadcasts running. Each recipient ends up with one status: sent,
+    blocked (bot blocked / user deactivated), bad_request, flood (still rate
+    limited after BROADCAST_MAX_ATTEMPTS tries), unknown (the request may
+    have reached Telegram, so it is not resent) or error.
+    """
+
+    def __init__(self, bot, message, recipients, bucket=broadcast_bucket, workers=BROADCAST_WORKERS):
+        self.bot = bot
+        self.message = message
+        self.recipients = list(recipients)
+        self.bucket = bucket
+        self.workers = workers
+        self.results = Counter()
+        self.stopped = False
+
+    def stop(self):
+        """Let in-flight sends finish but start no new ones"""
+        self.stopped = True
+
+    @property
+    def done(self):
+        return sum(self.results.values())
+
+    async def _send_one(self, user_id):
+        status = 'flood'
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=int(user_id), text=self.message)
+                self.bucket.success()
+                return 'sent'
+            except RetryAfter as e:
+                # Handle flood limits
+                self.bucket.flood_wait(_retry_after_seconds(e))
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                logger.error(f"Failed to send to {user_id}: {e}")
+                return 'bad_request'
+            except (TimedOut, NetworkError) as e:
+                if not _request_not_sent(e):
+                    # It may have been delivered: a retry could send it twice
+                    logger.warning(f"Send to {user_id} may or may not have arrived: {e}")
+                    return 'unknown'
+                logger.warning(f"Network error sending to {user_id} (attempt {attempt + 1}): {e}")
+                status = 'error'
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f"Failed to send to {user_id}: {e}")
+                return 'error'
+        return status
+
+    async def _worker(self, queue, on_result):
+        while not self.stopped:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status = await self._send_one(user_id)
+            self.results[status] += 1
+            if on_result:
+                on_result(user_id, status)
+
+    async def run(self, on_progress=None, on_result=None):
+        """Send to every recipient; on_progress(engine) is awaited periodically
+        and on_result(user_id, status) is called after each recipient"""
+        queue = asyncio.Queue()
+        for user_id in self.recipients:
+            queue.put_nowait(user_id)
+        workers = [asyncio.create_task(self._worker(queue, on_result)) for _ in range(self.workers)]
+        while not all(worker.done() for worker in workers):
+            await asyncio.wait(workers, timeout=BROADCAST_PROGRESS_INTERVAL)
+            if on_progress and not self.stopped and self.done < len(self.recipients):
+                try:
+                    await on_progress(self)
+                except Exception as e:
+                    logger.warning(f"Could not report broadcast progress: {e}")
+        for worker in workers:
+            worker.result()
+        return self.results
+
+def format_broadcast_results(results, total):
+    lines = [f"✅ Sent: {results.get('sent', 0)}"]
+    labels = {
+        'blocked': '🚫 Blocked bot',
+        'bad_request': '⚠️ Bad request',
+        'flood': '⏳ Rate limited',
+        'unknown': '❔ Unconfirmed (timed out)',
+        'error': '❌ Failed',
+    }
+    for status, label in labels.items():
+        if results.get(status):
+            lines.append(f"{label}: {results[status]}")
+    lines.append(f"👥 Total: {total}")
+    return '\n'.join(lines)
+
+class BroadcastOutbox:
+    """Persistent record of every broadcast and who has already received it.
+
+    The job definition (message, time, state, recipients) lives in
+    BROADCASTS_FILE. Per-recipient results are appended to
+    db/broadcasts/<id>.jsonl as soon as each send finishes, so after a
+    restart a broadcast resumes with only the recipients that have no
+    result yet and nobody gets the message twice. Once a broadcast is done
+    or cancelled only its per-status counts are kept: the recipient list
+    and the cursor file are dropped.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = {}
+
+    @property
+    def broadcasts(self):
+        return state_store.get(BROADCASTS_FILE)
+
+    def get(self, broadcast_id):
+        return self.broadcasts.get(broadcast_id)
+
+    def create(self, message, scheduled_at, segment=None):
+        broadcasts = self.broadcasts
+        broadcast_id = encode_base62(max((decode_base62(b) for b in broadcasts), default=0) + 1)
+        broadcasts[broadcast_id] = {
+            'message': message,
+            'scheduled_at': scheduled_at.isoformat(),
+            'created_at': datetime.now().isoformat(),
+            'state': 'scheduled',
+            'segment': segment or [],
+            'recipients': None,  # fixed when sending starts
+        }
+        state_store.mark_dirty(BROADCASTS_FILE)
+        return broadcast_id
+
+    def set_state(self, broadcast_id, state):
+        self.broadcasts[broadcast_id]['state'] = state
+        state_store.mark_dirty(BROADCASTS_FILE)
+        if state in ('done', 'cancelled'):
+            self._archive(broadcast_id)
+
+    def _archive(self, broadcast_id):
+        """Replace a finished broadcast's recipients and cursor with counts"""
+        broadcast = self.broadcasts[broadcast_id]
+        self.close(broadcast_id)
+        broadcast['results'] = dict(Counter(self.results(broadcast_id).values()))
+        broadcast['total'] = len(broadcast.pop('recipients', None) or [])
         try:
-            await context.bot.send_message(
-                chat_id=int(user_id_str),
-                text=message
-            )
-            success += 1
-        except RetryAfter as e:
-            # Handle flood limits
-            await asyncio.sleep(e.retry_after)
-            await context.bot.send_message(
-                chat_id=int(user_id_str),
-                text=message
-            )
-            success += 1
-        except Exception as e:
-            failed += 1
-            logger.error(f"Failed to send to {user_id_str}: {e}")
+            os.remove(self._cursor_path(broadcast_id))
+        except FileNotFoundError:
+            pass
+
+    def set_recipients(self, broadcast_id, recipients):
+        self.broadcasts[broadcast_id]['recipients'] = recipients
+        state_store.mark_dirty(BROADCASTS_FILE)
+
+    def _cursor_path(self, broadcast_id):
+        return os.path.join(self.directory, f"{broadcast_id}.jsonl")
+
+    def results(self, broadcast_id):
+        """{user_id: status} for every recipient already handled"""
+        results = {}
+        try:
+            with open(self._cursor_path(broadcast_id), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line after a crash
+                    results[record['user_id']] = record['status']
+        except FileNotFoundError:
+            pass
+        return results
+
+    def record(self, broadcast_id, user_id, status):
+        if self.broadcasts[broadcast_id]['state'] in ('done', 'cancelled'):
+            return  # a send still in flight when it was cancelled
+        f = self._files.get(broadcast_id)
+        if f is None:
+            os.makedirs(self.directory, exist_ok=True)
+            f = self._files[broadcast_id] = open(self._cursor_path(broadcast_id), 'a', encoding='utf-8')
+        f.write(json.dumps({'user_id': user_id, 'status': status}) + '\n')
+        f.flush()
+
+    def close(self, broadcast_id=None):
+        for key in [broadcast_id] if broadcast_id else list(self._files):
+            f = self._files.pop(key, None)
+            if f:
+                f.close()
+
+broadcast_outbox = BroadcastOutbox(BROADCAST_CURSOR_DIR)
+_running_broadcasts = {}  # broadcast id -> BroadcastEngine
+
+def schedule_broadcast_job(job_queue, broadcast_id):
+    broadcast = broadcast_outbox.get(broadcast_id)
+    when = datetime.fromisoformat(broadcast['scheduled_at'])
+    if broadcast['state'] != 'scheduled' or when <= datetime.now():
+        when = 0
+    job_queue.run_once(
+        callback=_send_broadcast,
+        when=when,
+        data={'broadcast_id': broadcast_id},
+        name=f"broadcast_{broadcast_id}"
+    )
+
+def resume_broadcasts(job_queue):
+    """Re-queue broadcasts that were scheduled or mid-send at shutdown"""
+    for broadcast_id, broadcast in broadcast_outbox.broadcasts.items():
+        if broadcast['state'] in ('scheduled', 'running'):
+            schedule_broadcast_job(job_queue, broadcast_id)
+            logger.info(f"Resuming broadcast {broadcast_id} ({broadcast['state']})")
+
+async def _send_broadcast(context: CallbackContext):
+    broadcast_id = context.job.data['broadcast_id']
+    broadcast = broadcast_outbox.get(broadcast_id)
+    if not broadcast or broadcast['state'] not in ('scheduled', 'running') or broadcast_id in _running_broadcasts:
+        return
+
+    if broadcast['recipients'] is None:
+        broadcast_outbox.set_recipients(broadcast_id, audience_index.resolve(broadcast.get('segment', [])))
+    broadcast_outbox.set_state(broadcast_id, 'running')
+    await state_store.flush_async()
+
+    recipients = broadcast['recipients']
+    handled = broadcast_outbox.results(broadcast_id)
+    results = Counter(handled.values())
+    pending = [user_id for user_id in recipients if user_id not in handled]
+
+    engine = BroadcastEngine(context.bot, broadcast['message'], pending)
+    _running_broadcasts[broadcast_id] = engine
+
+    progress = await context.bot.send_message(
+        chat_id=ADMIN_ID,
+        text=f"📢 Broadcast {broadcast_id} started: {len(handled)}/{len(recipients)}"
+    )
+
+    async def report_progress(engine):
+        await progress.edit_text(
+            f"📢 Broadcast {broadcast_id} in progress: {len(handled) + engine.done}/{len(recipients)}\n"
+            f"✅ Sent: {results.get('sent', 0) + engine.results.get('sent', 0)}"
+        )
+
+    def record_result(user_id, status):
+        broadcast_outbox.record(broadcast_id, user_id, status)
+
+    try:
+        await engine.run(on_progress=report_progress, on_result=record_result)
+    finally:
+        _running_broadcasts.pop(broadcast_id, None)
+
+    results.update(engine.results)
+    if broadcast['state'] == 'running':
+        if engine.stopped:
+            # Paused and resumed before the old senders drained: pick up the rest
+            schedule_broadcast_job(context.job_queue, broadcast_id)
+            return
+        broadcast_outbox.set_state(broadcast_id, 'done')
+    await state_store.flush_async()
 
     # Notify admin of results
+    title = {'done': 'results', 'paused': 'paused', 'cancelled': 'cancelled'}[broadcast['state']]
     await context.bot.send_message(
         chat_id=ADMIN_ID,
-        text=f"📢 Broadcast results:\n✅ Success: {success}\n❌ Failed: {failed}"
+        text=f"📢 Broadcast {broadcast_id} {title}:\n{format_broadcast_results(results, len(recipients))}"
     )
 
 async def schedule_broadcast(update: Update, context: CallbackContext):
@@ -1016,10 +3213,20 @@ async def schedule_broadcast(update: Update, context: CallbackContext):
         await update.message.reply_text("❌ Admin only.")
         return
 
-    if len(context.args) < 3:
+    try:
+        segment, message_args = parse_segment(context.args[2:])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    if len(context.args) < 3 or not message_args:
         await update.message.reply_text(
-            "Usage: /schedulebroadcast <YYYY-MM-DD> <HH:MM> <message>\n"
-            "Example: /schedulebroadcast 2023-12-25 10:00 'Merry Christmas!'"
+            "Usage: /schedulebroadcast <YYYY-MM-DD> <HH:MM> [to:<segment>...] <message>\n"
+            "Example: /schedulebroadcast 2023-12-25 10:00 to:sub:movielex 'Merry Christmas!'\n\n"
+            "Segments (all must match):\n"
+            "to:sub | to:sub:movielex,animelex - active subscribers\n"
+            "to:balance<3000 - balance below 3000\n"
+            "to:watched:7 - watched a video in the last 7 days\n"
+            "to:referred | to:referred:<user_id> - users who joined by referral"
         )
         return
 
@@ -1027,25 +3234,83 @@ async def schedule_broadcast(update: Update, context: CallbackContext):
         # Parse datetime
         date_str = context.args[0]
         time_str = context.args[1]
-        message = ' '.join(context.args[2:])
+        message = ' '.join(message_args)
         scheduled_time = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
 
-        # Schedule the job
-        context.job_queue.run_once(
-            callback=_send_broadcast,
-            when=scheduled_time,
-            data={'message': message},
-            name=f"broadcast_{scheduled_time}"
-        )
+        # Persist before scheduling so a restart cannot lose it
+        broadcast_id = broadcast_outbox.create(message, scheduled_time, segment)
+        await state_store.flush_async()
+        schedule_broadcast_job(context.job_queue, broadcast_id)
 
+        audience = ' '.join(segment) if segment else 'all users'
         await update.message.reply_text(
-            f"✅ Broadcast scheduled for {scheduled_time}!\n"
-            f"Message: {message}"
+            f"✅ Broadcast {broadcast_id} scheduled for {scheduled_time}!\n"
+            f"Audience: {audience} (currently {len(audience_index.resolve(segment))})\n"
+            f"Message: {message}\n\n"
+            f"/broadcasts pause|resume|cancel {broadcast_id}"
         )
 
     except ValueError as e:
         await update.message.reply_text(f"❌ Invalid date/time format. Use YYYY-MM-DD HH:MM.\nError: {e}")
 
+async def broadcasts_command(update: Update, context: CallbackContext):
+    """List broadcasts or pause/resume/cancel one (admin only)"""
+    if not is_admin(update):
+        await update.message.reply_text("❌ Admin only.")
+        return
+
+    if not context.args:
+        broadcasts = broadcast_outbox.broadcasts
+        active = [(b_id, b) for b_id, b in broadcasts.items() if b['state'] not in ('done', 'cancelled')]
+        if not active:
+            await update.message.reply_text("No scheduled or running broadcasts.")
+            return
+        lines = ["📢 Broadcasts:"]
+        for broadcast_id, broadcast in active:
+            total = len(broadcast['recipients']) if broadcast['recipients'] is not None else '?'
+            handled = len(broadcast_outbox.results(broadcast_id))
+            lines.append(
+                f"{broadcast_id} [{broadcast['state']}] {broadcast['scheduled_at'][:16]} "
+                f"{handled}/{total}: {broadcast['message'][:40]}"
+            )
+        lines.append("\nUsage: /broadcasts pause|resume|cancel <id>")
+        await update.message.reply_text('\n'.join(lines))
+        return
+
+    if len(context.args) != 2 or context.args[0] not in ('pause', 'resume', 'cancel'):
+        await update.message.reply_text("Usage: /broadcasts [pause|resume|cancel <id>]")
+        return
+
+    action, broadcast_id = context.args
+    broadcast = broadcast_outbox.get(broadcast_id)
+    if not broadcast:
+        await update.message.reply_text(f"❌ Broadcast {broadcast_id} not found.")
+        return
+
+    state = broadcast['state']
+    if action == 'pause' and state in ('scheduled', 'running'):
+        # Remember where sending stood: resume continues from there
+        broadcast_outbox.set_state(broadcast_id, 'paused')
+    elif action == 'resume' and state == 'paused':
+        # Paused before it started: it still goes out at scheduled_at
+        resumed = 'scheduled' if broadcast['recipients'] is None else 'running'
+        broadcast_outbox.set_state(broadcast_id, resumed)
+        schedule_broadcast_job(context.job_queue, broadcast_id)
+    elif action == 'cancel' and state in ('scheduled', 'running', 'paused'):
+        broadcast_outbox.set_state(broadcast_id, 'cancelled')
+    else:
+        await update.message.reply_text(f"❌ Cannot {action} a {state} broadcast.")
+        return
+
+    if action != 'resume':
+        engine = _running_broadcasts.get(broadcast_id)
+        if engine:
+            engine.stop()
+        for job in context.job_queue.get_jobs_by_name(f"broadcast_{broadcast_id}"):
+            job.schedule_removal()
+    await state_store.flush_async()
+    await update.message.reply_text(f"✅ Broadcast {broadcast_id}: {broadcast['state']}")
+
 async def send_message_to_user(update: Update, context: CallbackContext) -> None:
     """Send a message to a specific user (admin only)"""
     if not is_admin(update):
@@ -1107,10 +3372,7 @@ async def update_metadata(update: Update, context: CallbackContext) -> None:
     field = context.args[1].lower()
     value = ' '.join(context.args[2:])
     
-    # Load video data
-    video_data = load_video_data()
-    
-    if video_name not in video_data:
+    if video_name not in catalog:
         await update.message.reply_text(f"Video '{video_name}' not found.")
         return
     
@@ -1141,8 +3403,7 @@ async def update_metadata(update: Update, context: CallbackContext) -> None:
             return
     
     # Update the field
-    video_data[video_name][field] = value
-    save_video_data(video_data)
+    catalog.update_field(video_name, field, value)
     
     await update.message.reply_text(
         f"✅ Updated {field} for '{video_name}':\n\n{value}"
@@ -1170,8 +3431,11 @@ async def handle_screenshot(update: Update, context: CallbackContext) -> None:
         )
                 
         # Forward to admin with instructions
+        user_context = get_user_context(context, user)
+        blocked_note = "🚫 This user is blocked\n" if user_context.blocked else ""
         caption = (f"🆕 Payment screenshot from @{user.username or user.first_name} (ID: {user.id})\n"
-                  f"Current balance: {get_user_balance(user.id)}\n"
+                  f"Current balance: {user_context.balance}\n"
+                  f"{blocked_note}"
                   f"User message: {update.message.caption or 'No caption'}\n\n")
         
         await context.bot.send_photo(
@@ -1205,163 +3469,139 @@ async def handle_screenshot(update: Update, context: CallbackContext) -> None:
 async def send_video_with_limit_check(update: Update, context: CallbackContext, user, video_name):
     """Handle video sending with balance checks"""
     # Get video price
-    video_data = load_video_data()
-    if video_name not in video_data:
+    video = catalog.get(video_name)
+    if video is None:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Кино олдсонгүй."
         )
         return False
     
-    # Check if user has active subscription
-    subscription = get_user_subscription(user.id)
-    if subscription:
-        now = datetime.now()
-        end_date = datetime.fromisoformat(subscription['end_date'])
-        video_category = video_data[video_name].get('category', 'other')
-
-        if now < end_date:
-            # Check if subscription covers this video
-            if (subscription['category'] == 'all' or 
-                subscription['category'] == video_category or
-                (subscription['category'] == 'lgbtlex' and video_category in ['bl', 'gl'])):
-                # Subscription covers this video
-                try:
-                    await context.bot.send_video(
-                        chat_id=update.effective_chat.id,
-                        video=video_db[video_name],
-                        protect_content=True,
-                        caption=f"Таны үзэхийг хүссэн кино энэ байна. (Subscription active)"
-                    )
-                    log_sent_video(user.id, video_name)
-                    return True
-                except Exception as e:
-                    logger.error(f"Error sending video: {e}")
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text="Кино илгээхэд алдаа гарлаа."
-                    )
-                    return False
+    user_context = get_user_context(context, user)
+
+    # Check if user has a subscription covering this video
+    video_category = video.get('category', 'other')
+    if user_context.can_watch(video):
+        try:
+            await context.bot.send_video(
+                chat_id=update.effective_chat.id,
+                video=video['file_id'],
+                protect_content=True,
+                caption=f"Таны үзэхийг хүссэн кино энэ байна. (Subscription active)"
+            )
+            log_sent_video(user.id, video_name)
+            return True
+        except Exception as e:
+            logger.error(f"Error sending video: {e}")
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="Кино илгээхэд алдаа гарлаа."
+            )
+            return False
 
-    video_price = video_data[video_name].get('price', 0)
+    video_price = video.get('price', 0)
     
-    # Check if user has already paid for this video
-    if has_user_paid_for_video(user.id, video_name):
-        # User has already paid, just send the video without deducting balance
+    async with balance_transaction(user.id) as tx:
+        # Check if user has already paid for this video
+        if user_context.has_paid(video):
+            # User has already paid, just send the video without deducting balance
+            try:
+                await context.bot.send_video(
+                    chat_id=update.effective_chat.id,
+                    video=video['file_id'],
+                    protect_content=True,
+                    caption=f"Таны үзэхгийг хүссэн кино энэ байна. Таны дансны үлдэгдэл: {tx.balance}"
+                )
+                log_sent_video(user.id, video_name)
+                return True
+            except Exception as e:
+                logger.error(f"Error sending video: {e}")
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text="Кино илгээхэд алдаа гарлаа."
+                )
+                return False
+        
+        # First time watching this video - check balance and deduct
+        user_balance = tx.balance
+
+        if user_balance < video_price:
+            # Check if user has a subscription for another category
+            subscriptions = user_context.subscriptions
+            if subscriptions:
+                categories = ', '.join(g['category'] for g in subscriptions)
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text=f"Таны захиалга {categories} категорид хүрэхгүй байна. "
+                         f"Энэ кино {video_category} категорид багтана.\n\n"
+                         f"Киноны үнэ: {video_price}, Таны үлдэгдэл: {user_balance}\n\n"
+                         "Үргэлжлүүлэн үзэхийг хүсвэл төлбөр төлнө үү:\n\n"
+                         "🏦Данс Хаан банк:\nО.МӨНХ-ЭРДЭНЭ 592 627 1236\n"
+                         "🏦IBAN дугаар:\nMN34 0005 00 592 627 1236\n\n"
+                         f"👀Гүйлгээний утга:\nөөрийнхөө утасны дугаар + (багцын нэр)\n\n"
+                         "📍📍Шилжүүлснийхээ дараа төлбөр төлсөн дэлгэцийн зургаа дарж ийшээ явуулна уу."
+                )
+            else:
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text=f"Таны үлдэгдэл хүрэлцэхгүй байна. Киноны үнэ: {video_price}, Таны үлдэгдэл: {user_balance}\n\n"
+                    "Та өөрийн дансандаа хэдэн ч төгрөг хийх боломжтой. Шинээр кино үзэхэд таны данснаас хасагдаад явах болноо.\n\n\n"
+                    "Кино ДАНГААР нь авбал доорх үнээр авна:\n"
+                    "1 кино = 1500 төгрөг (Movielex)\n"
+                    "1 кино = 1000 төгрөг (Seriallex)\n"
+                    "1 кино = 1000 төгрөг (LGBTlex)\n"
+                    "1 аниме = 500 төгрөг (Animelex)\n\n\n"
+                    "Кино БАГЦААР нь авбал доорх үнээр авна:\n"
+                    "1 сар = 10000 төгрөг (БҮГД)\n"
+                    "1 сар = 5000 төгрөг (Movielex)\n"
+                    "1 сар = 5000 төгрөг (Seriallex)\n"
+                    "1 сар = 5000 төгрөг (LGBTlex)\n"
+                    "1 сар = 5000 төгрөг (Animelex)\n\n"
+                    "🏦Данс Хаан банк:\nО.МӨНХ-ЭРДЭНЭ 5926271236\n\n"
+                    "🏦IBAN Хаан банк:\nО.МӨНХ-ЭРДЭНЭ MN34 0005 00 5926271236\n\n"
+                    f"👀Гүйлгээний утга:\nөөрийнхөө утасны дугаар + (багцын нэр)\n\n"
+                    "📍📍Шилжүүлснийхээ дараа төлбөр төлсөн дэлгэцийн зургаа дарж ийшээ явуулна уу.\n\n"
+                    "🫡🤗Хэрвээ зураг явуулсан бол 1 хоногийн дотор баталгаажих болноо. Та түр хүлээнэ үү🫡🤗\n\n"
+                    "⚠️⚠️Зураг явуулаагүй бол шалгах гэж нэлээн удаж магадгүй. Анхаарна уу.\n"
+                )
+            return False
+        
+        # Deduct balance only if this is the first time watching
+        if not tx.deduct(video_price, ref=f"video:{video['id']}"):
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="Алдаа гарлаа. Төлбөр хасагдаагүй байна."
+            )
+            return False
+        
+        # Send the video
         try:
             await context.bot.send_video(
                 chat_id=update.effective_chat.id,
-                video=video_db[video_name],
+                video=video['file_id'],
                 protect_content=True,
-                caption=f"Таны үзэхгийг хүссэн кино энэ байна. Таны дансны үлдэгдэл: {get_user_balance(user.id)}"
+                caption=f"Таны үзэхгийг хүссэн кино энэ байна. Таны дансны үлдэгдэл: {tx.balance}"
             )
-            log_sent_video(user.id, video_name)
-            return True
         except Exception as e:
+            # Refund if sending failed
+            tx.refund()
             logger.error(f"Error sending video: {e}")
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text="Кино илгээхэд алдаа гарлаа."
+                text="Кино илгээхэд алдаа гарлаа. Төлбөр буцаагдлаа."
             )
             return False
-    
-    # First time watching this video - check balance and deduct
-    user_balance = get_user_balance(user.id)
 
-    if user_balance < video_price:
-        # Check if user has a subscription for another category
-        if subscription:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Таны захиалга {subscription['category']} категорид хүрэхгүй байна. "
-                     f"Энэ кино {video_category} категорид багтана.\n\n"
-                     f"Киноны үнэ: {video_price}, Таны үлдэгдэл: {user_balance}\n\n"
-                     "Үргэлжлүүлэн үзэхийг хүсвэл төлбөр төлнө үү:\n\n"
-                     "🏦Данс Хаан банк:\nО.МӨНХ-ЭРДЭНЭ 592 627 1236\n"
-                     "🏦IBAN дугаар:\nMN34 0005 00 592 627 1236\n\n"
-                     f"👀Гүйлгээний утга:\nөөрийнхөө утасны дугаар + (багцын нэр)\n\n"
-                     "📍📍Шилжүүлснийхээ дараа төлбөр төлсөн дэлгэцийн зургаа дарж ийшээ явуулна уу."
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Таны үлдэгдэл хүрэлцэхгүй байна. Киноны үнэ: {video_price}, Таны үлдэгдэл: {user_balance}\n\n"
-                "Та өөрийн дансандаа хэдэн ч төгрөг хийх боломжтой. Шинээр кино үзэхэд таны данснаас хасагдаад явах болноо.\n\n\n"
-                "Кино ДАНГААР нь авбал доорх үнээр авна:\n"
-                "1 кино = 1500 төгрөг (Movielex)\n"
-                "1 кино = 1000 төгрөг (Seriallex)\n"
-                "1 кино = 1000 төгрөг (LGBTlex)\n"
-                "1 аниме = 500 төгрөг (Animelex)\n\n\n"
-                "Кино БАГЦААР нь авбал доорх үнээр авна:\n"
-                "1 сар = 10000 төгрөг (БҮГД)\n"
-                "1 сар = 5000 төгрөг (Movielex)\n"
-                "1 сар = 5000 төгрөг (Seriallex)\n"
-                "1 сар = 5000 төгрөг (LGBTlex)\n"
-                "1 сар = 5000 төгрөг (Animelex)\n\n"
-                "🏦Данс Хаан банк:\nО.МӨНХ-ЭРДЭНЭ 5926271236\n\n"
-                "🏦IBAN Хаан банк:\nО.МӨНХ-ЭРДЭНЭ MN34 0005 00 5926271236\n\n"
-                f"👀Гүйлгээний утга:\nөөрийнхөө утасны дугаар + (багцын нэр)\n\n"
-                "📍📍Шилжүүлснийхээ дараа төлбөр төлсөн дэлгэцийн зургаа дарж ийшээ явуулна уу.\n\n"
-                "🫡🤗Хэрвээ зураг явуулсан бол 1 хоногийн дотор баталгаажих болноо. Та түр хүлээнэ үү🫡🤗\n\n"
-                "⚠️⚠️Зураг явуулаагүй бол шалгах гэж нэлээн удаж магадгүй. Анхаарна уу.\n"
-            )
-        return False
-    
-    # Deduct balance only if this is the first time watching
-    if not deduct_user_balance(user.id, video_price):
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Алдаа гарлаа. Төлбөр хасагдаагүй байна."
-        )
-        return False
-    
-    # Send the video
-    try:
-        await context.bot.send_video(
-            chat_id=update.effective_chat.id,
-            video=video_db[video_name],
-            protect_content=True,
-            caption=f"Таны үзэхгийг хүссэн кино энэ байна. Таны дансны үлдэгдэл: {get_user_balance(user.id)}"
-        )
         log_sent_video(user.id, video_name)
-        
-        # Record the transaction
-        record_user_activity(
-            user.id,
-            user.username,
-            user.first_name,
-            user.last_name,
-            video_name
-        )
-
-        # Update user's movie count
-        activity_data = load_user_activity()
-        user_id_str = str(user.id)
+        record_purchase(user.id, video_name)
 
-        if user_id_str not in activity_data:
-            update_user_activity(user.id, {
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'movies_watched': 1
-            })
-        else:
-            current_count = activity_data[user_id_str].get('movies_watched', 0)
-            update_user_activity(user.id, {'movies_watched': current_count + 1})
+    # Update user's movie count
+    user_context.record_watch()
 
-        # Process referral credits if they've reached a multiple of 5
-        await process_referral_credits(user.id, context)  # Fixed this line
-        
-        return True
-    except Exception as e:
-        # Refund if sending failed
-        add_user_balance(user.id, video_price)
-        logger.error(f"Error sending video: {e}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Кино илгээхэд алдаа гарлаа. Төлбөр буцаагдлаа."
-        )
-        return False
+    # Process referral credits if they've reached a multiple of 5
+    await process_referral_credits(user.id, context)
+    
+    return True
     
 async def notify_admin_limit_reached(context: CallbackContext, user):
     """Notify admin when a user reaches the limit"""
@@ -1454,6 +3694,72 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
             chat_type=update.effective_chat.type
         )
 
+MAX_TRAILERS = 5
+
+# video id -> (trailer ids, album media or None when the album was rejected)
+_trailer_albums = {}
+
+def _trailer_album(video):
+    trailers = tuple(video.get('trailer_ids', [])[:MAX_TRAILERS])
+    cached = _trailer_albums.get(video['id'])
+    if cached is None or cached[0] != trailers:
+        # Built once per title and rebuilt only when its trailers change
+        cached = (trailers, [InputMediaVideo(media=trailer_id) for trailer_id in trailers])
+        _trailer_albums[video['id']] = cached
+    return cached
+
+async def send_trailers(bot, chat_id, video):
+    """Send a title's trailers as one album, or one by one if that fails"""
+    trailers, album = _trailer_album(video)
+    if album and len(album) > 1:
+        try:
+            await bot.send_media_group(chat_id=chat_id, media=album, protect_content=True)
+            return
+        except BadRequest as e:
+            # e.g. a trailer that cannot go in an album: stop trying for this title
+            logger.error(f"Trailer album rejected for {video['id']}: {e}")
+            _trailer_albums[video['id']] = (trailers, None)
+        except Exception as e:
+            # The album may have arrived anyway (e.g. a timeout): don't send it twice
+            logger.error(f"Error sending trailer album: {e}")
+            return
+
+    for trailer_id in trailers:
+        try:
+            await bot.send_video(chat_id=chat_id, video=trailer_id, protect_content=True)
+        except Exception as e:
+            logger.error(f"Error sending trailer: {e}")
+
+INLINE_RESULTS_PER_PAGE = 20
+INLINE_CACHE_TIME = 300  # seconds Telegram may serve the same results for a query
+
+async def inline_query(update: Update, context: CallbackContext) -> None:
+    """Search the catalog from any chat with @bot <query>"""
+    query = update.inline_query
+    offset = int(query.offset or 0)
+    names = catalog_search.search(query.query)
+    page = names[offset:offset + INLINE_RESULTS_PER_PAGE]
+
+    results = []
+    for name in page:
+        video = catalog.get(name)
+        # The deep link goes through /start v_<code>, i.e. the normal paid path
+        link = f"https://t.me/{context.bot.username}?start=v_{video['code']}"
+        details = ', '.join(str(v) for v in (video.get('year'), video.get('genre')) if v)
+        results.append(InlineQueryResultArticle(
+            id=video['code'],
+            title=video.get('title_name') or name,
+            description=f"{details}\n⭐ {video.get('rating', '-')} · {video.get('price', 0)}₮",
+            thumbnail_url=video.get('poster') or None,
+            input_message_content=InputTextMessageContent(
+                f"🎬 {video.get('title_name') or name}\n{details}\n\n{link}"
+            ),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Үзэх", url=link)]]),
+        ))
+
+    next_offset = str(offset + INLINE_RESULTS_PER_PAGE) if offset + INLINE_RESULTS_PER_PAGE < len(names) else ''
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+
 async def start(update: Update, context: CallbackContext) -> None:
     """Handle /start command with video requests"""
     user = update.effective_user
@@ -1463,49 +3769,38 @@ async def start(update: Update, context: CallbackContext) -> None:
     if context.args and context.args[0].isdigit():
         referrer_id = context.args[0]
         
-        # Only process if this is a new user (not already referred)
-        activity_data = load_user_activity()
-        user_id_str = str(user.id)
-        
-        if user_id_str not in activity_data or not activity_data[user_id_str].get('referred_by'):
-            # Validate referrer exists
-            if referrer_id in activity_data and referrer_id != user_id_str:
-                # Update new user's referred_by
-                update_user_activity(user.id, {
-                    'username': user.username,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'referred_by': referrer_id
-                })
-                
-                # Add to referrer's referrals list
-                referrer_data = activity_data.get(referrer_id, {})
-                referrals = referrer_data.get('referrals', [])
-                if user_id_str not in referrals:
-                    referrals.append(user_id_str)
-                    update_user_activity(int(referrer_id), {'referrals': referrals})
-                
-                await update.message.reply_text(
-                    f"🎉 Та {activity_data[referrer_id].get('first_name')}-гийн урилгаар бүртгүүллээ! "
-                    "5 кино үзэх бүрт хоёулаа бонус авах болно."
-                )
+        # Only new (not yet referred) users, and never one of their own referrers
+        if referral_engine.link(user, referrer_id):
+            await update.message.reply_text(
+                f"🎉 Та {load_user_activity()[referrer_id].get('first_name')}-гийн урилгаар бүртгүүллээ! "
+                "5 кино үзэх бүрт хоёулаа бонус авах болно."
+            )
 
-    if context.args and context.args[0].startswith('video_'):
-        video_name = context.args[0][6:]
-        if video_name in video_db:
+    if context.args and context.args[0].startswith(('v_', 'video_')):
+        # v_<code>, or video_<slug> from older links (former slugs still resolve)
+        if context.args[0].startswith('v_'):
+            video_name = context.args[0][2:]
+            current_name = catalog.by_code(video_name)
+        else:
+            video_name = context.args[0][6:]
+            current_name = catalog.resolve(video_name)
+        if current_name:
             await update.message.reply_text("Кино илгээж байна...хүлээнэ үү🫡")
-            success = await send_video_with_limit_check(update, context, user, video_name)
+            success = await send_video_with_limit_check(update, context, user, current_name)
             if not success:
                 return
-    elif context.args and context.args[0].startswith('trailer_'):
-        video_name = context.args[0][8:]
-        video_data = load_video_data()
+    elif context.args and context.args[0].startswith(('t_', 'trailer_')):
+        if context.args[0].startswith('t_'):
+            video_name = catalog.by_code(context.args[0][2:])
+        else:
+            video_name = catalog.resolve(context.args[0][8:])
+        video = catalog.get(video_name)
         
-        if video_name not in video_data:
+        if video is None:
             await update.message.reply_text(f"Кино олдсонгүй ээ 😣😖😭😵‍💫 {LINK}")
             return
             
-        trailers = video_data[video_name].get('trailer_ids', [])
+        trailers = video.get('trailer_ids', [])
         
         if not trailers:
             await update.message.reply_text(f"Энэ кинонд трейлер олдсонгүй. 😣😖😭😵‍💫 {LINK}")
@@ -1513,22 +3808,11 @@ async def start(update: Update, context: CallbackContext) -> None:
             
         await update.message.reply_text("Трейлерүүд илгээж байна...хүлээнэ үү 🫡")
         
-        # Send all trailers
-        for trailer_id in trailers[:5]:  # Limit to 5 trailers
-            try:
-                await context.bot.send_video(
-                    chat_id=update.effective_chat.id,
-                    video=trailer_id,
-                    protect_content=True
-                )
-                await asyncio.sleep(1)  # Small delay between trailers
-            except Exception as e:
-                logger.error(f"Error sending trailer: {e}")
-                continue
+        await send_trailers(context.bot, update.effective_chat.id, video)
                 
         # Ask if they want to watch the full movie
         keyboard = [
-            [InlineKeyboardButton("Тийм", callback_data=f"video_{video_name}")],
+            [InlineKeyboardButton("Тийм", callback_data=f"v_{video['code']}")],
             [InlineKeyboardButton("Үгүй", callback_data="trailer_no")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1546,46 +3830,156 @@ async def start(update: Update, context: CallbackContext) -> None:
     else:
         await update.message.reply_text(f'Сайн байна уу? {user.first_name}!. {LINK} руу орж киногоо сонгоно уу.')
 
-async def blocked_users(update: Update, context: CallbackContext) -> None:
-    """Show list of blocked users (admin only)"""
-    if not is_admin(update):
-        await update.message.reply_text("Зөвхөн админ.")
-        return
-    
-    blocked_users = load_blocked_users()
-    if not blocked_users:
-        await update.message.reply_text("No users are currently blocked.")
-        return
-    
-    message = ["🚫 Blocked Users:"]
-    keyboard = []
-
-    for user_id, data in blocked_users.items():
+def build_blocked_report():
+    rows = []
+    buttons = []
+    for user_id, data in load_blocked_users().items():
+        button = None
         if data.get('unblocked'):
             status = "✅ Unblocked"
         else:
             status = "❌ Blocked"
             # Add unblock button for blocked users
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"Unblock {data.get('first_name', 'User')} (ID: {user_id})",
-                    callback_data=f"unblock_{user_id}"
-                )
-            ])
-        
-        message.append(
+            button = InlineKeyboardButton(
+                f"Unblock {data.get('first_name', 'User')} (ID: {user_id})",
+                callback_data=f"unblock_{user_id}"
+            )
+        rows.append(
             f"\n👤 {data.get('first_name', 'Unknown')} "
             f"(ID: {user_id}) - @{data.get('username', 'no_username')}\n"
             f"Blocked at: {data.get('blocked_at')}\n"
             f"Status: {status}"
         )
+        buttons.append(button)
+    return Report("🚫 Blocked Users:", rows, buttons=buttons, empty="No users are currently blocked.")
 
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+async def blocked_users(update: Update, context: CallbackContext) -> None:
+    """Show list of blocked users (admin only)"""
+    if not is_admin(update):
+        await update.message.reply_text("Зөвхөн админ.")
+        return
     
-    await update.message.reply_text(
-        '\n'.join(message),
-        reply_markup=reply_markup
-    )
+    await reply_report(update, 'blocked')
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handle updates concurrently while keeping each chat's updates in order.
+
+    Updates from different chats run in parallel, capped at
+    max_concurrent_updates by the base class. The first update of a chat
+    (or of a user, for chat-less updates) runs as usual; updates arriving
+    while it runs are queued behind it and run by the same call, in order.
+    A queued update returns at once and gives its slot back, so a burst from
+    one chat holds a single slot and cannot stall the others.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chat_queues = {}  # ordering key -> updates waiting behind the running one
+
+    @staticmethod
+    def _ordering_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        if key is None:
+            await coroutine
+            return
+        pending = self._chat_queues.get(key)
+        if pending is not None:
+            pending.append(coroutine)
+            return
+        pending = self._chat_queues[key] = deque()
+        try:
+            while True:
+                try:
+                    await coroutine
+                except Exception as e:
+                    # Keep going: the updates queued behind it still have to run
+                    logger.error(f"Error processing update for chat {key}: {e}")
+                if not pending:
+                    break
+                coroutine = pending.popleft()
+        finally:
+            del self._chat_queues[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class UserContext:
+    """State of the user behind one update, looked up once.
+
+    load_user_context builds it before any handler runs and handlers get it
+    with get_user_context instead of looking the same records up again.
+    balance and blocked are read once, when the update arrives; balance
+    changes still go through balance_transaction, whose tx.balance is the
+    live figure. activity, subscriptions and purchases are the in-memory
+    records themselves. commit_user_context marks the stores touched
+    through it dirty once, after the last handler.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.user_id = str(user.id)
+        self.activity = load_user_activity().get(self.user_id)  # None until first seen
+        self.balance = get_user_balance(self.user_id)
+        self.subscriptions = entitlements.grants(self.user_id)
+        # record_purchase adds the user's set on their first purchase
+        self.purchases = _get_purchase_index().get(self.user_id, frozenset())
+        self.blocked = is_user_blocked(self.user_id)
+        self._touched = set()
+
+    def can_watch(self, video):
+        return entitlements.can_watch(self.user_id, video.get('category', 'other'))
+
+    def has_paid(self, video):
+        if not self.purchases:
+            # The first purchase may have been made since (e.g. from another chat)
+            self.purchases = _get_purchase_index().get(self.user_id, frozenset())
+        return video.get('id') in self.purchases
+
+    def record_watch(self):
+        """Count one more video in the user's activity"""
+        if self.activity is None:
+            self.activity = update_user_activity(self.user.id, {
+                'username': self.user.username,
+                'first_name': self.user.first_name,
+                'last_name': self.user.last_name
+            })
+        self.activity['movies_watched'] = self.activity.get('movies_watched', 0) + 1
+        self._touched.add(USER_ACTIVITY_FILE)
+
+    def commit(self):
+        for path in self._touched:
+            state_store.mark_dirty(path)
+        self._touched.clear()
+
+def get_user_context(context: CallbackContext, user):
+    """The update's UserContext when it is about user, else a fresh one"""
+    user_context = getattr(context, 'user_context', None)
+    if user_context is None or user_context.user_id != str(user.id):
+        user_context = UserContext(user)
+    return user_context
+
+async def load_user_context(update: Update, context: CallbackContext) -> None:
+    """Runs first (group -1) for every update"""
+    if update.effective_user:
+        context.user_context = UserContext(update.effective_user)
+
+async def commit_user_context(update: Update, context: CallbackContext) -> None:
+    """Runs last for every update"""
+    user_context = getattr(context, 'user_context', None)
+    if user_context is not None:
+        user_context.commit()
 
 def is_admin(update: Update):
     """Check if user is admin"""
@@ -1611,39 +4005,8 @@ async def addvideo(update: Update, context: CallbackContext) -> None:
         
         video_file_id = update.message.reply_to_message.video.file_id
         
-        # Load existing data
-        video_data = load_video_data()
-
         # Create or update the video entry
-        if video_name not in video_data:
-            video_data[video_name] = {
-                "title": video_name,
-                "title_name": video_name,  # Default title_name same as title
-                "year": datetime.now().year,
-                "genre": "Unknown",
-                "duration": "Unknown",
-                "rating": 0.0,
-                "description": "No description available",
-                "director": "Unknown",
-                "cast": "Unknown",
-                "release": datetime.now().strftime('%B %Y'),
-                "poster": "",
-                "category": "other",
-                "file_id": video_file_id,
-                "trailer_ids": [],
-                "date_added": datetime.now().isoformat(),
-                "price": price
-            }
-        else:
-            # Just update the file_id if video exists
-            video_data[video_name]['file_id'] = video_file_id
-            video_data[video_name]['price'] = price
-
-        # Save the updated data
-        save_video_data(video_data)
-        
-        # Update the video_db mapping
-        video_db[video_name] = video_file_id
+        catalog.add_video(video_name, video_file_id, price)
 
         await update.message.reply_text(f"Video '{video_name}' added successfully with price {price}!")
     else:
@@ -1663,70 +4026,75 @@ async def addtrailer(update: Update, context: CallbackContext) -> None:
         video_name = ' '.join(context.args)
         trailer_file_id = update.message.reply_to_message.video.file_id
         
-        video_data = load_video_data()
-        
-        if video_name not in video_data:
+        if video_name not in catalog:
             await update.message.reply_text(f"Video '{video_name}' not found. Add it first with /addvideo")
             return
             
-        # Initialize trailers array if not exists
-        if 'trailer_ids' not in video_data[video_name]:
-            video_data[video_name]['trailer_ids'] = []
-            
         # Add the trailer
-        video_data[video_name]['trailer_ids'].append(trailer_file_id)
-        save_video_data(video_data)
+        trailers = catalog.add_trailer(video_name, trailer_file_id)
         
         await update.message.reply_text(
             f"✅ Trailer added to '{video_name}'!\n"
-            f"Total trailers: {len(video_data[video_name]['trailer_ids'])}"
+            f"Total trailers: {len(trailers)}"
         )
     else:
         await update.message.reply_text("Please reply to a video message with this command.")
 
 
 async def sync(update: Update, context: CallbackContext) -> None:
-    """Manually sync video data (admin only)"""
+    """Force a catalog reload (admin only); normally changes are picked up automatically"""
     if not is_admin(update):
         await update.message.reply_text("Зөвхөн админ.")
         return
     
-    if sync_video_data():
+    if catalog.refresh(force=True):
         await update.message.reply_text("Video database synchronized successfully!")
     else:
         await update.message.reply_text("No changes needed - databases are already in sync.")
 
+# Longer windows and lists show everything anyway
+VIDEO_LOGS_MAX_DAYS = 3650
+VIDEO_LOGS_MAX_TOP = 1000
+
+def parse_video_logs_args(args):
+    """(days, top) from /videologs args: window ('7d') and top-N ('top10' or '10'), unknown args ignored"""
+    days = top = None
+    for arg in args:
+        if arg.endswith('d') and arg[:-1].isdigit():
+            days = min(int(arg[:-1]), VIDEO_LOGS_MAX_DAYS) or None
+        elif arg.removeprefix('top').isdigit():
+            top = min(int(arg.removeprefix('top')), VIDEO_LOGS_MAX_TOP) or None
+    return days, top
+
+def video_logs_args(args):
+    """Canonical form of /videologs args, e.g. ('7d', 'top10'): short enough for callback data"""
+    days, top = parse_video_logs_args(args)
+    return tuple(arg for arg in (days and f"{days}d", top and f"top{top}") if arg)
+
+def build_video_logs_report(*args):
+    """args: optional window ('7d') and top-N ('top10' or '10')"""
+    days, top = parse_video_logs_args(args)
+    titles, categories = delivery_counters.totals(days)
+    if not titles:
+        return Report("", [], empty="No video delivery logs found.")
+
+    window = f" (last {days} days)" if days else ""
+    rows = [f"{delivery_counters.title_name(title)}: {count}" for title, count in titles.most_common(top)]
+    title = (
+        f"📊 Video Delivery Statistics{window}:\n"
+        f"\nTotal videos sent: {sum(titles.values())}\n"
+        f"\nBy category: {', '.join(f'{c}: {n}' for c, n in categories.most_common())}\n"
+        f"\n{f'Top {top} videos' if top else 'Unique videos sent'}:"
+    )
+    return Report(title, rows, footer="\nOptions: /videologs [7d] [top10]", empty="No video delivery logs found.")
+
 async def video_logs(update: Update, context: CallbackContext) -> None:
     """Show video delivery logs (admin only) from video_logs.json"""
     if not is_admin(update):
         await update.message.reply_text("Зөвхөн админ.")
         return
     
-    logs = load_video_logs()
-    
-    # Collect all video delivery logs
-    video_counts = {}
-    total_sends = 0
-    
-    for user_id, data in logs.items():
-        if 'deliveries' in data:
-            for log in data['deliveries']:
-                video_name = log['video_name']
-                video_counts[video_name] = video_counts.get(video_name, 0) + 1
-                total_sends += 1
-    
-    if not video_counts:
-        await update.message.reply_text("No video delivery logs found.")
-        return
-        
-    message = ["📊 Video Delivery Statistics:"]
-    message.append(f"\nTotal videos sent: {total_sends}")
-    message.append("\nUnique videos sent:")
-    
-    for video, count in sorted(video_counts.items(), key=lambda x: x[1], reverse=True):
-        message.append(f"{video}: {count}")
-        
-    await update.message.reply_text('\n'.join(message))
+    await reply_report(update, 'videologs', video_logs_args(context.args))
 
 async def rename(update: Update, context: CallbackContext) -> None:
     """Rename video in database (admin only)"""
@@ -1741,28 +4109,12 @@ async def rename(update: Update, context: CallbackContext) -> None:
     old_name = ' '.join(context.args[:-1])
     new_name = context.args[-1]
 
-    # Load video data
-    video_data = load_video_data()
-    
-    if old_name in video_data:
-        # Update video_data
-        video_data[new_name] = video_data.pop(old_name)
-        # Update title if it matches old name
-        if video_data[new_name]['title'] == old_name:
-            video_data[new_name]['title'] = new_name
-        save_video_data(video_data)
-        
-        # Update video_db
-        video_db[new_name] = video_db.pop(old_name)
-        
-        # Update video logs
-        video_logs = load_video_logs()
-        for user_data in video_logs.values():
-            for delivery in user_data.get('deliveries', []):
-                if delivery['video_name'] == old_name:
-                    delivery['video_name'] = new_name
-        save_video_logs(video_logs)
-        
+    if old_name in catalog:
+        if not catalog.rename(old_name, new_name):
+            await update.message.reply_text(f"A video named '{new_name}' already exists.")
+            return
+
+        # Logs and purchases reference the video id, so nothing else changes
         await update.message.reply_text(f"Video renamed from '{old_name}' to '{new_name}'")
     else:
         await update.message.reply_text(f"Video '{old_name}' not found.")
@@ -1779,60 +4131,89 @@ async def delete(update: Update, context: CallbackContext) -> None:
     
     video_name = ' '.join(context.args)
     
-    # Load video data
-    video_data = load_video_data()
-    
-    if video_name in video_data:
-        # Remove from video_data
-        del video_data[video_name]
-        save_video_data(video_data)
-        
-        # Remove from video_db
-        if video_name in video_db:
-            del video_db[video_name]
+    if video_name in catalog:
+        catalog.delete(video_name)
         
         await update.message.reply_text(f"Video '{video_name}' deleted successfully!")
     else:
         await update.message.reply_text(f"Video '{video_name}' not found.")
 
+LIST_PAGE_SIZE = 10
+LIST_TABS_PER_ROW = 4
+
+# For the current catalog revision: ordered names per tab, and rendered
+# pages (category, page) -> (text, markup)
+_video_list_names = {}
+_video_list_pages = {}
+_video_list_revision = None
+
+def render_video_list(category, page):
+    """Text and keyboard for one /list page; cached until the catalog changes"""
+    global _video_list_revision
+    if _video_list_revision != catalog.revision:
+        _video_list_names.clear()
+        _video_list_pages.clear()
+        _video_list_revision = catalog.revision
+
+    names = _video_list_names.get(category)
+    if names is None:
+        if category == 'all':
+            names = sorted(name for name, _ in catalog.items())
+        else:
+            names = catalog.newest(category=category)
+        _video_list_names[category] = names
+    pages = max(1, (len(names) + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE)
+    page = max(1, min(page, pages))
+    cached = _video_list_pages.get((category, page))
+    if cached:
+        return cached
+
+    tabs = [
+        InlineKeyboardButton(f"• {tab} •" if tab == category else tab, callback_data=f"ls_{tab}_1")
+        for tab in ['all', *catalog.categories()]
+    ]
+    keyboard = [tabs[i:i + LIST_TABS_PER_ROW] for i in range(0, len(tabs), LIST_TABS_PER_ROW)]
+    for name in names[(page - 1) * LIST_PAGE_SIZE:page * LIST_PAGE_SIZE]:
+        data = catalog.get(name)
+        # Show title_name if available, otherwise title
+        display_name = data.get('title', name)
+        keyboard.append([InlineKeyboardButton(display_name, callback_data=f"v_{data['code']}")])
+    if pages > 1:
+        keyboard.append([
+            InlineKeyboardButton("◀️", callback_data=f"ls_{category}_{page - 1 if page > 1 else pages}"),
+            InlineKeyboardButton(f"{page}/{pages}", callback_data="noop"),
+            InlineKeyboardButton("▶️", callback_data=f"ls_{category}_{page + 1 if page < pages else 1}"),
+        ])
+
+    text = f"Available videos ({category}, {len(names)}):"
+    _video_list_pages[(category, page)] = (text, InlineKeyboardMarkup(keyboard))
+    return _video_list_pages[(category, page)]
+
 async def list_videos(update: Update, context: CallbackContext) -> None:
     """List all available videos with details"""
     if not is_admin(update):
         await update.message.reply_text("Зөвхөн админ")
         return
     
-    video_data = load_video_data()
-    if not video_data:
+    if len(catalog) == 0:
         await update.message.reply_text("Кино одсонгүй.")
         return
     
     # Group by category if requested
     if context.args and context.args[0] == 'bycategory':
-        categories = {}
-        for name, data in video_data.items():
-            category = data.get('category', 'other')
-            if category not in categories:
-                categories[category] = []
-            categories[category].append(name)
-        
         message = ["📺 Videos by Category:"]
-        for category, videos in categories.items():
+        for category in catalog.categories():
             message.append(f"\n\n🎬 {category.upper()}:")
-            for video in sorted(videos):
+            for video in catalog.newest(category=category):
                 message.append(f"- {video}")
         
         await update.message.reply_text('\n'.join(message))
         return
     
     # Default listing
-    keyboard = []
-    for name, data in sorted(video_data.items()):
-        # Show title_name if available, otherwise title
-        display_name = data.get('title', name)
-        keyboard.append([InlineKeyboardButton(display_name, callback_data=f"video_{name}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text('Available videos:', reply_markup=reply_markup)
+    category = context.args[0] if context.args and context.args[0] in catalog.categories() else 'all'
+    text, reply_markup = render_video_list(category, 1)
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
 async def button(update: Update, context: CallbackContext) -> None:
     """Handle button presses"""
@@ -1841,9 +4222,15 @@ async def button(update: Update, context: CallbackContext) -> None:
 
     try:
         # Keep only the video and unblock button handling
-        if query.data.startswith('video_'):
-            video_name = query.data[6:]
-            if video_name in video_db:
+        if query.data.startswith(('v_', 'vid_', 'video_')):
+            # v_<code>; vid_<id> and video_<slug> come from buttons sent earlier
+            if query.data.startswith('v_'):
+                video_name = catalog.by_code(query.data[2:])
+            elif query.data.startswith('vid_'):
+                video_name = catalog.name_of(int(query.data[4:]))
+            else:
+                video_name = catalog.resolve(query.data[6:])
+            if video_name in catalog:
                 user = query.from_user
                 try:
                     success = await send_video_with_limit_check(update, context, user, video_name)
@@ -1859,6 +4246,43 @@ async def button(update: Update, context: CallbackContext) -> None:
         elif query.data == 'trailer_no':
             await query.edit_message_text(text="За, дараа үзнэ үү!")   
 
+        elif query.data == 'noop':
+            pass
+
+        elif query.data.startswith('rp_'):
+            # rp_<report>_<page>_<args>: admin report navigation, edited in place
+            if is_admin(update):
+                name, page, args = query.data[3:].split('_', 2)
+                args = tuple(args.split())
+                text, reply_markup = get_report(name, args).render(name, args, int(page))
+                try:
+                    await query.edit_message_text(text=text, reply_markup=reply_markup)
+                except BadRequest as e:
+                    if 'not modified' not in str(e):
+                        raise
+
+        elif query.data.startswith('ls_'):
+            # ls_<category or all>_<page>: /list navigation, edited in place
+            if is_admin(update):
+                category, page = query.data[3:].rsplit('_', 1)
+                text, reply_markup = render_video_list(category, int(page))
+                try:
+                    await query.edit_message_text(text=text, reply_markup=reply_markup)
+                except BadRequest as e:
+                    # Same page pressed again: Telegram refuses an identical edit
+                    if 'not modified' not in str(e):
+                        raise
+
+        elif query.data.startswith('uph_'):
+            # uph_<user_id>_<page>_<from YYYYMMDD>_<to YYYYMMDD>
+            if is_admin(update):
+                user_id, page, start, end = query.data[4:].split('_')
+                await query.edit_message_reply_markup(reply_markup=None)
+                await send_user_photos(
+                    context.bot, query.message.chat_id, int(user_id), page=int(page),
+                    start=_parse_photo_date(start), end=_parse_photo_date(end)
+                )
+
         elif query.data.startswith('unblock_'):
             user_id = int(query.data[8:])
             if is_admin(update):
@@ -1926,91 +4350,184 @@ async def button(update: Update, context: CallbackContext) -> None:
                     text="Sorry, an error occurred while processing your request."
                 )
 
+SEARCH_PAGE_SIZE = 15
+
+def search_tokens(text):
+    """Case-folded words of text (works the same for Cyrillic and Latin)"""
+    return SEARCH_TOKEN.findall((text or '').casefold())
+
+class MessageSearchIndex:
+    """Inverted index over chat_logs.json for /stats search:.
+
+    Messages are numbered in timestamp order, so every posting list is
+    sorted and a date range is a slice found with bisect. Built from the
+    in-memory chat logs on the first search, then extended by
+    log_user_message as messages arrive.
+    """
+
+    def __init__(self):
+        self._built = False
+
+    def invalidate(self):
+        self._built = False
+
+    def _build(self):
+        self._docs = []          # doc id -> (timestamp, user_id, entry)
+        self._timestamps = []
+        self._postings = {}      # token -> [doc ids]
+        self._by_user = {}       # user_id -> [doc ids]
+        messages = sorted(
+            ((entry.get('timestamp', ''), user_id, entry)
+             for user_id, user_log in load_chat_logs().items()
+             for entry in user_log.get('messages', [])),
+            key=lambda message: message[0]
+        )
+        self._built = True
+        for _, user_id, entry in messages:
+            self.add(user_id, entry)
+
+    def _ensure_built(self):
+        if not self._built:
+            self._build()
+
+    def add(self, user_id, entry):
+        if not self._built:
+            return
+        timestamp = entry.get('timestamp', '')
+        if self._timestamps and timestamp < self._timestamps[-1]:
+            # Out-of-order entry: renumbering is cheaper done in one go
+            self.invalidate()
+            return
+        doc_id = len(self._docs)
+        self._docs.append((timestamp, user_id, entry))
+        self._timestamps.append(timestamp)
+        for token in set(search_tokens(entry.get('text'))):
+            self._postings.setdefault(token, []).append(doc_id)
+        self._by_user.setdefault(user_id, []).append(doc_id)
+
+    def search(self, words=(), phrases=(), user_ids=None, start=None, end=None):
+        """Matching (timestamp, user_id, entry) tuples, newest first"""
+        self._ensure_built()
+        low = bisect.bisect_left(self._timestamps, start) if start else 0
+        high = bisect.bisect_left(self._timestamps, end) if end else len(self._docs)
+
+        tokens = set(words)
+        for phrase in phrases:
+            tokens.update(search_tokens(phrase))
+        candidates = set()
+        if tokens:
+            # Intersect starting from the rarest token
+            lists = sorted((self._postings.get(token, []) for token in tokens), key=len)
+            candidates = set(lists[0])
+            for postings in lists[1:]:
+                candidates.intersection_update(postings)
+        if user_ids is not None:
+            user_docs = set()
+            for user_id in user_ids:
+                user_docs.update(self._by_user.get(user_id, []))
+            candidates = candidates & user_docs if tokens else user_docs
+
+        padded_phrases = [f" {' '.join(search_tokens(p))} " for p in phrases]
+        results = []
+        for doc_id in sorted(candidates, reverse=True):
+            if not low <= doc_id < high:
+                continue
+            timestamp, user_id, entry = self._docs[doc_id]
+            if padded_phrases:
+                text = f" {' '.join(search_tokens(entry.get('text')))} "
+                if not all(phrase in text for phrase in padded_phrases):
+                    continue
+            results.append((timestamp, user_id, entry))
+        return results
+
+message_index = MessageSearchIndex()
+
+SEARCH_QUERY = re.compile(r'"([^"]+)"|(\S+)')
+
 async def search_user_messages(update: Update, context: CallbackContext, search_term: str) -> None:
-    """Search through user messages in user_activity.json"""
+    """Search through user messages in chat_logs.json.
+
+    Query syntax: words (all must match), "exact phrase", user:<id>|@username,
+    from:YYYY-MM-DD, to:YYYY-MM-DD and page:N.
+    """
     try:
-        # Parse user filter syntax: "user:1234" or "user:@username"
+        words, phrases = [], []
         user_filter = None
-        actual_search_term = search_term
+        start = end = None
+        page = 1
+        for phrase, word in SEARCH_QUERY.findall(search_term):
+            lowered = word.lower()
+            if phrase:
+                phrases.append(phrase)
+            elif lowered.startswith('user:'):
+                user_filter = word[5:]
+            elif lowered.startswith('from:'):
+                start = datetime.strptime(word[5:], "%Y-%m-%d").isoformat()
+            elif lowered.startswith('to:'):
+                # Inclusive: everything before the following midnight
+                end = (datetime.strptime(word[3:], "%Y-%m-%d") + timedelta(days=1)).isoformat()
+            elif lowered.startswith('page:'):
+                page = max(1, int(word[5:]))
+            else:
+                words.extend(search_tokens(word))
 
-        # Check for user: prefix
-        if 'user:' in search_term.lower():
-            parts = search_term.split('user:', 1)
-            user_part = parts[1].split()[0]  # Get the user specifier
-            actual_search_term = ' '.join(parts[1].split()[1:]) if len(parts[1].split()) > 1 else ''
-            
+        if not (words or phrases or user_filter):
+            await update.message.reply_text(
+                "Please provide a search term or user filter\n"
+                "Example: /stats search:кино user:@username from:2025-01-01 to:2025-01-31 \"exact phrase\""
+            )
+            return
+
+        chat_logs = load_chat_logs()
+        user_ids = None
+        if user_filter:
             # Check if user is ID or username
-            if user_part.startswith('@'):
-                user_filter = {'username': user_part[1:].lower()}
+            if user_filter.startswith('@'):
+                username = user_filter[1:].lower()
+                user_ids = [
+                    user_id for user_id, user_log in chat_logs.items()
+                    if (user_log.get('username') or '').lower() == username
+                ]
+            elif user_filter.isdigit():
+                user_ids = [user_filter]
             else:
-                try:
-                    user_filter = {'user_id': int(user_part)}
-                except ValueError:
-                    await update.message.reply_text("Invalid user ID. Use @username or numeric ID")
-                    return
-            
-        if not actual_search_term and not user_filter:
-            await update.message.reply_text("Please provide a search term or user filter")
-            return
+                await update.message.reply_text("Invalid user ID. Use @username or numeric ID")
+                return
 
-        activity_data = load_user_activity()
-        
-        # Filter messages containing the search term (case insensitive)
-        results = []
-        for user_id, data in activity_data.items():
-            # Skip if no chat logs
-            if 'chat_log' not in data:
-                continue
-                
-            # Apply user filter if specified
-            if user_filter:
-                if 'user_id' in user_filter and int(user_id) != user_filter['user_id']:
-                    continue
-                if 'username' in user_filter and data.get('username', '').lower() != user_filter['username']:
-                    continue
-            
-            # Search through chat logs
-            for msg in data['chat_log']:
-                if actual_search_term and actual_search_term.lower() not in msg.get('text', '').lower():
-                    continue
-                
-                # Add matching messages to results
-                results.append({
-                    'timestamp': msg['timestamp'],
-                    'user_id': user_id,
-                    'username': data.get('username'),
-                    'first_name': data.get('first_name'),
-                    'text': msg['text']
-                })
+        results = message_index.search(words, phrases, user_ids, start, end)
         
         if not results:
             await update.message.reply_text("No matching messages found.")
             return
         
         # Format results with pagination
-        response = ["🔍 Search results:"]
+        pages = (len(results) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+        page = min(page, pages)
+        response = [f"🔍 Search results: page {page}/{pages}, {len(results)} messages"]
         if user_filter:
             response[0] += f" (filtered by user: {user_filter})"
         
-        # Sort by timestamp (newest first)
-        results.sort(key=lambda x: x['timestamp'], reverse=True)
-        
-        for i, msg in enumerate(results[:15], 1):  # Show first 15 results
-            timestamp = datetime.fromisoformat(msg['timestamp']).strftime('%Y-%m-%d %H:%M')
+        first = (page - 1) * SEARCH_PAGE_SIZE
+        for i, (timestamp, user_id, msg) in enumerate(results[first:first + SEARCH_PAGE_SIZE], first + 1):
+            user_log = chat_logs.get(user_id, {})
+            timestamp = datetime.fromisoformat(timestamp).strftime('%Y-%m-%d %H:%M')
             response.append(
-                f"\n{i}. {timestamp} - @{msg.get('username', '?')} "
-                f"({msg.get('first_name', 'Unknown')}):\n"
-                f"{msg['text']}"
+                f"\n{i}. {timestamp} - @{user_log.get('username') or '?'} "
+                f"({user_log.get('first_name') or 'Unknown'}, {user_id}):\n"
+                f"{msg.get('text')}"
             )
         
-        if len(results) > 15:
-            response.append(f"\n\nℹ️ Showing 15 of {len(results)} results.")
+        if page < pages:
+            query = re.sub(r'\s*page:\d+', '', search_term).strip()
+            response.append(f"\n\nℹ️ Next page: /stats search:{query} page:{page + 1}")
         
         # Split long messages to avoid Telegram's message length limit
         full_response = '\n'.join(response)
         for i in range(0, len(full_response), 4000):
             await update.message.reply_text(full_response[i:i+4000])
             
+    except ValueError:
+        await update.message.reply_text("Invalid date or page. Dates are YYYY-MM-DD.")
     except Exception as e:
         logger.error(f"Error searching messages: {e}")
         await update.message.reply_text("An error occurred while searching messages.")
@@ -2036,31 +4553,37 @@ async def user_stats(update: Update, context: CallbackContext) -> None:
         search_term = ' '.join(context.args)[7:]  # Remove 'search:' prefix
         return await search_user_messages(update, context, search_term)
 
-    video_logs = load_video_logs()
-    
-    if not video_logs:
-        await update.message.reply_text("No user activity recorded yet.")
-        return
-    
-    message = ["📊 User Activity Report:"]
+    await reply_report(update, 'stats')
+
+def build_stats_report():
+    rows = []
     total_sends = 0
     
-    for user_id, data in video_logs.items():
+    for user_id, data in load_video_logs().items():
         username = data.get('username', 'unknown')
         video_count = len(data.get('deliveries', []))
         total_sends += video_count
-        last_video = data['deliveries'][-1]['video_name'] if data.get('deliveries') else 'none'
+        last_video = delivery_video_name(data['deliveries'][-1]) if data.get('deliveries') else 'none'
         
-        message.append(
+        rows.append(
             f"\n👤 User: {username} (ID: {user_id})\n"
             f"📹 Videos sent: {video_count}\n"
             f"🎬 Last video: {last_video}"
         )
     
-    message.append(f"\n\n📈 Total videos sent: {total_sends}")
-    message.append("\n\n🔍 Search user messages with: /stats search:<query>")
-    
-    await update.message.reply_text('\n'.join(message))
+    footer = (
+        f"\n\n📈 Total videos sent: {total_sends}"
+        "\n\n\n🔍 Search user messages with: /stats search:<query>"
+    )
+    return Report("📊 User Activity Report:", rows, footer=footer, empty="No user activity recorded yet.")
+
+REPORT_BUILDERS = {
+    'stats': build_stats_report,
+    'videologs': build_video_logs_report,
+    'subscriptions': build_subscriptions_report,
+    'blocked': build_blocked_report,
+    'ledger': build_ledger_report,
+}
 
 async def error_handler(update: Update, context: CallbackContext) -> None:
     """Log errors and send a message to the user"""
@@ -2088,7 +4611,7 @@ async def send_video_to_user(update: Update, context: CallbackContext) -> None:
         user_id = int(context.args[0])
         video_name = ' '.join(context.args[1:])
         
-        if video_name not in video_db:
+        if video_name not in catalog:
             await update.message.reply_text(f"Video '{video_name}' not found.")
             return
             
@@ -2096,7 +4619,7 @@ async def send_video_to_user(update: Update, context: CallbackContext) -> None:
         try:
             await context.bot.send_video(
                 chat_id=user_id,
-                video=video_db[video_name],
+                video=catalog.file_id(video_name),
                 protect_content=True,
                 caption="Админаас илгээсэн кино"
             )
@@ -2165,7 +4688,7 @@ async def aldaa(update: Update, context: CallbackContext) -> None:
         )
         
         # Log that this video was sent
-        log_sent_video(user.id, "aldaa_troubleshooting_video")
+        log_sent_video(user.id, TROUBLESHOOT_VIDEO_NAME)
         
     except Exception as e:
         logger.error(f"Error sending aldaa video: {e}")
@@ -2175,20 +4698,36 @@ async def aldaa(update: Update, context: CallbackContext) -> None:
 
 def main() -> None:
     """Start the bot."""
-    load_dotenv()
-    
-    # Load and sync video database at startup
-    load_video_db()
-    sync_video_data()
+    # Load the video catalog at startup
+    catalog.refresh(force=True)
+    upgrade_video_references()
+    catalog_search.refresh()
+    delivery_counters.build()
 
     TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
     if not TOKEN:
         logger.error("Telegram bot token not found in environment variables")
         return
     
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_shutdown(flush_state_on_shutdown)
+        .build()
+    )
+
+    # Write dirty state back to db/*.json in the background
+    application.job_queue.run_repeating(flush_state_job, interval=STATE_FLUSH_INTERVAL, first=STATE_FLUSH_INTERVAL)
+    resume_broadcasts(application.job_queue)
+    subscription_scheduler.start(application.job_queue)
+    application.job_queue.run_repeating(ledger_snapshot_job, interval=LEDGER_SNAPSHOT_INTERVAL, first=LEDGER_SNAPSHOT_INTERVAL)
 
     # Command handlers
+    # Resolve the user's state once per update, and write it back after the handlers
+    application.add_handler(TypeHandler(Update, load_user_context), group=-1)
+    application.add_handler(TypeHandler(Update, commit_user_context), group=100)
+
     application.add_handler(CommandHandler("sync", sync))
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("addvideo", addvideo))
@@ -2202,11 +4741,13 @@ def main() -> None:
     application.add_handler(CommandHandler("updatemeta", update_metadata))
     application.add_handler(CommandHandler("sendmessage", send_message_to_user))
     application.add_handler(CommandHandler("schedulebroadcast", schedule_broadcast))
+    application.add_handler(CommandHandler("broadcasts", broadcasts_command))
     application.add_handler(CommandHandler("sendvideo", send_video_to_user))
     application.add_handler(CommandHandler("addtrailer", addtrailer))
     application.add_handler(CommandHandler("userphotos", user_photos))
     application.add_handler(CommandHandler("addbalance", add_balance))
     application.add_handler(CommandHandler("balance", balance))    
+    application.add_handler(CommandHandler("ledger", ledger_command))
     application.add_handler(CommandHandler("subset", set_subscription))
     application.add_handler(CommandHandler("subscriptions", view_subscriptions))
     application.add_handler(CommandHandler("subhistory", subscription_history))
@@ -2216,6 +4757,7 @@ def main() -> None:
 
     # Other handlers
     application.add_handler(CallbackQueryHandler(button))
+    application.add_handler(InlineQueryHandler(inline_query))
     application.add_handler(MessageHandler(filters.VIDEO, handle_video))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, handle_screenshot))
@@ -2227,4 +4769,7 @@ def main() -> None:
     application.run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if sys.argv[1:] == ['migrate']:
+        migrate_json_to_sqlite()
+    else:
+        main()
\ No newline at end of file
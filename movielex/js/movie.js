@@ -29,7 +29,7 @@ document.addEventListener('DOMContentLoaded', async () => {
     
     // Trailer link
     const trailerLink = document.getElementById('trailer-link');
-    trailerLink.href = `https://t.me/meme_kino_bot?start=trailer_${encodeURIComponent(movie.title)}`;
+    trailerLink.href = telegramStartLink(movie, 'trailer');
     
     // Video player functionality
     const watchBtn = document.getElementById('watch-btn');
@@ -7,6 +7,7 @@ async function loadMovieData() {
     try {
         const response = await fetch('./movie-details.json');
         movieData = await response.json();
+        buildMovieIndexes();
         return movieData;
     } catch (error) {
         console.error('Error loading movie data:', error);
@@ -14,30 +15,41 @@ async function loadMovieData() {
     }
 }
 
-// Get movies by category
+// Indexes built once per load so lookups don't filter/sort the whole catalog
+let moviesByCategory = {};
+let moviesByDate = [];
+
+function dateAddedValue(movie) {
+    return movie.date_added ? new Date(movie.date_added).getTime() : 0;
+}
+
+function buildMovieIndexes() {
+    moviesByDate = Object.values(movieData)
+        .sort((a, b) => dateAddedValue(b) - dateAddedValue(a));
+    moviesByCategory = {};
+    for (const movie of moviesByDate) {
+        const category = (movie.category || 'other').toLowerCase();
+        (moviesByCategory[category] = moviesByCategory[category] || []).push(movie);
+    }
+}
+
+// Get movies by category, newest first (shared index - do not modify)
 function getMoviesByCategory(category) {
-    return Object.values(movieData)
-        .filter(movie => movie.category.toLowerCase() === category.toLowerCase())
-        .sort((a, b) => {
-            // Sort by date_added if available, otherwise use current order
-            if (a.date_added && b.date_added) {
-                return new Date(b.date_added) - new Date(a.date_added);
-            }
-            return 0;
-        });
+    return moviesByCategory[category.toLowerCase()] || [];
 }
 
 // Get newest movies
 function getNewestMovies(limit = 5) {
-    const allMovies = Object.values(movieData);
-    return allMovies
-        .sort((a, b) => {
-            if (a.date_added && b.date_added) {
-                return new Date(b.date_added) - new Date(a.date_added);
-            }
-            return 0;
-        })
-        .slice(0, limit);
+    return moviesByDate.slice(0, limit);
+}
+
+// Telegram deep link for a movie ('video' or 'trailer'). The bot's short
+// code keeps the payload within Telegram's 64-character start limit.
+function telegramStartLink(movie, kind) {
+    const payload = movie.code
+        ? `${kind[0]}_${movie.code}`
+        : `${kind}_${encodeURIComponent(movie.title)}`;
+    return `https://t.me/meme_kino_bot?start=${payload}`;
 }
 
 // Create movie card HTML
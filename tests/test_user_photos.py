@@ -0,0 +1,28 @@
+import pytest
+
+import bot
+
+
+def test_start_and_end_dates():
+    assert bot.parse_user_photos_args(['2024-01-01', '2024-01-31']) == ('2024-01-01', '2024-01-31', 1)
+
+
+def test_start_date_only():
+    assert bot.parse_user_photos_args(['2024-01-01', '2']) == ('2024-01-01', None, 2)
+
+
+def test_open_start_range():
+    assert bot.parse_user_photos_args(['..2024-01-31']) == (None, '2024-01-31', 1)
+
+
+def test_open_end_range():
+    assert bot.parse_user_photos_args(['2024-01-01..', '3']) == ('2024-01-01', None, 3)
+
+
+def test_closed_range():
+    assert bot.parse_user_photos_args(['2024-01-01..2024-01-31']) == ('2024-01-01', '2024-01-31', 1)
+
+
+def test_invalid_date():
+    with pytest.raises(ValueError):
+        bot.parse_user_photos_args(['..2024-13-01'])